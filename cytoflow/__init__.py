@@ -4,20 +4,15 @@ from operations.range import RangeOp
 from operations.range2d import Range2DOp
 from operations.polygon import PolygonOp
 from operations.hlog import HlogTransformOp
-<<<<<<< HEAD
-# from operations.logicle import LogicleTransformOp
-from operations.import_op import ImportOp, Tube
-from operations.mixtureModel import MixtureModelOp
-=======
 from operations.logicle import LogicleTransformOp
 from operations.log import LogTransformOp
 from operations.import_op import ImportOp, Tube
+from operations.mixtureModel import MixtureModelOp
 from operations.autofluorescence import AutofluorescenceOp
 from operations.bleedthrough_piecewise import BleedthroughPiecewiseOp
 from operations.bead_calibration import BeadCalibrationOp
 from operations.color_translation import ColorTranslationOp
 from operations.binning import BinningOp
->>>>>>> refs/remotes/bpteague/master
 
 from views.histogram import HistogramView
 from views.hexbin import HexbinView
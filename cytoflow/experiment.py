@@ -1,7 +1,101 @@
+import os
+import re
+import json
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
-from traits.api import HasStrictTraits, Dict, List, Instance, Set, Str, Any
+from traits.api import HasStrictTraits, Dict, List, Instance, Set, Str, Any, \
+                       Property, Enum, Tuple, Float, Int
+
+from utility import CytoflowError, BitSet, Transform, ComposedTransform, \
+                    ColumnStore, check_cancelled
+
+# how many query() masks to keep per Experiment
+_QUERY_CACHE_SIZE = 16
+
+# the format written by Experiment.save()
+_FILE_FORMAT = "cytoflow experiment"
+_FILE_VERSION = 1
+_HEADER_FILE = "experiment.json"
+_METADATA_FILE = "metadata.pickle"
+_CATEGORIES_FILE = "categories.pickle"
+
+def _map_chunks(fn, arrays, out, chunk_size):
+    """
+    Fill `out` with `fn(*arrays)`, `chunk_size` elements at a time (or all 
+    at once, if `chunk_size` is 0.)  Checks for cancellation before each 
+    chunk (see `cytoflow.utility.cancellable()`.)
+    """
+    
+    n = len(out)
+    step = chunk_size if chunk_size > 0 else max(n, 1)
+    for start in range(0, n, step):
+        check_cancelled()
+        stop = min(start + step, n)
+        out[start:stop] = fn(*[a[start:stop] for a in arrays])
+    return out
+
+def _from_json(value):
+    """
+    Undo json's conversion of `str` to `unicode`, in `value` and in any
+    lists and dicts in it.
+    """
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return value
+    elif isinstance(value, list):
+        return [_from_json(v) for v in value]
+    elif isinstance(value, dict):
+        return {_from_json(k) : _from_json(v) for k, v in value.iteritems()}
+    else:
+        return value
+
+def _pin(frame):
+    """
+    Stop pandas from consolidating `frame`'s blocks.  pandas copies all the
+    columns of a dtype into one new block when it consolidates, which would
+    copy columns that are shared with a clone, or read memory-mapped ones
+    (see ColumnStore) into memory.
+    """
+    frame._data._is_consolidated = True
+    frame._data._known_consolidated = True
+    return frame
+
+def _replace_columns(frame, new_columns):
+    """
+    A new DataFrame with `frame`'s columns, except those in the dict
+    `new_columns` (which are replaced, or added at the end.)  The columns
+    aren't copied: each numeric column is wrapped as its own block, so the
+    new frame shares the columns it didn't replace with `frame`.
+    """
 
-from utility import CytoflowError
+    columns = [(c, new_columns.get(c, frame[c])) for c in frame.columns]
+    columns += [(c, values) for c, values in new_columns.iteritems()
+                if c not in frame.columns]
+
+    new_frame = pd.DataFrame(index = frame.index)
+    for name, values in columns:
+        if isinstance(values, pd.Series):
+            values = values.values
+
+        if isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+            if len(values) != len(frame.index):
+                raise ValueError("Length of values does not match length of "
+                                 "index")
+            
+            # DataFrame.insert() would copy the values
+            new_frame._data.insert(len(new_frame.columns),
+                                   name,
+                                   values[np.newaxis, :])
+        else:
+            new_frame[name] = values
+
+    return _pin(new_frame)
 
 class Experiment(HasStrictTraits):
     """An Experiment manages all the data and metadata for a flow experiment.
@@ -38,7 +132,44 @@ class Experiment(HasStrictTraits):
         the DataFrame representing all the events and metadata.  Each event
         is a row; each column is either a fluorescent channel or a piece of
         metadata, either supplied by the tube conditions or by further operations
-        (like gates, etc.)
+        (like gates, etc.)  An Experiment made by `clone()` shares the
+        column buffers of the original, so change columns with 
+        `ex[column] = ...` rather than by writing into `data` in place.
+        Per-channel transforms and filters (see `transform_channel()`) are
+        applied when `data` is read.
+        
+    columns : list(Str)
+        The names of the columns in `data`: the channels, the conditions 
+        and the gates.  Reading it doesn't unpack the gates.
+        
+    nbytes : Int
+        Roughly how much memory the events use, in bytes, without building
+        `data`.  It's an upper bound: columns shared with a clone, or kept 
+        on disk by `storage`, are counted too.  (`nbytes_apart_from()` 
+        leaves out the shared ones.)
+        
+    dtype : Enum("float64", "float32") (default = "float64")
+        The dtype the channels are stored as.  Most FCS files store their
+        events as 32-bit floats; "float32" keeps them that way and halves the
+        memory an Experiment needs.  Set it before adding any tubes.  
+        Operations that write a channel have their results converted to this 
+        dtype (see `__setitem__`); estimators still do their arithmetic in 
+        float64.
+        
+    chunk_size : Int (default = 0)
+        If > 0, elementwise work (the pending transforms and filters, and 
+        anything an operation computes with `map_events()`, like gates and 
+        bins) is done this many events at a time, writing into an output 
+        that's allocated once.  The temporaries are then bounded by the 
+        chunk size instead of growing with the number of events, which 
+        keeps peak memory down for very large experiments.  0 does each 
+        computation on all the events at once.  Clones inherit it.
+        
+    storage : ColumnStore (default = None)
+        If set, keep the events' numeric columns in memory-mapped files on 
+        disk (see `cytoflow.utility.ColumnStore`) instead of in memory, so 
+        the Experiment can be bigger than RAM.  Set it before adding any 
+        tubes.  Clones share it.
         
     metadata : dict( str : dict(str : any) )
         A dict whose keys are column names (either channels or conditions)
@@ -55,7 +186,9 @@ class Experiment(HasStrictTraits):
             transformations that have been applied.  each must be a
             one-parameter function that takes either a single value or a list 
             of values and applies the transformation (or inverse).  necessary
-            for computing tic marks on plots, among other things.
+            for computing tic marks on plots, among other things.  use a
+            `cytoflow.utility.Transform` rather than a lambda, so the
+            Experiment can still be pickled.
         
     Notes
     -----              
@@ -126,26 +259,508 @@ class Experiment(HasStrictTraits):
     # potentially mutable.  deep copy required
     metadata = Dict(Str, Any, copy = "deep")
     
+    # the dtype to store the channels as
+    dtype = Enum("float64", "float32")
+    
+    # how many events to process at a time; 0 for all of them
+    chunk_size = Int(0)
+    
+    # where to keep the events, if not in memory
+    storage = Instance(ColumnStore, copy = "ref")
+    
+    # the events.  reading it concatenates any tubes that are still pending
+    # (see finalize()), so it's a property wrapping _data.
+    data = Property(Instance(pd.DataFrame), transient = True)
+    
+    # roughly how much memory the events use
+    nbytes = Property(transient = True)
+    
+    # the columns in data, without building it
+    columns = Property(transient = True)
+    
     # this doesn't play nice with copy.copy(); clone it ourselves.
-    data = Instance(pd.DataFrame, args=())
+    _data = Instance(pd.DataFrame, args=(), copy = "ref")
+    
+    # blocks of events that add_tube() (or merge()) has accepted but that 
+    # haven't been concatenated onto _data yet.  each is a tuple of 
+    # (DataFrame, conditions).  for a tube, conditions is a dict of 
+    # condition name --> its value, as a one-element Series of the 
+    # condition's dtype, and the DataFrame only has the channels: the 
+    # condition columns are built in finalize().  for a merged Experiment, 
+    # conditions is None and the DataFrame already has its condition columns.
+    _blocks = List(Tuple(Instance(pd.DataFrame), Any), transient = True)
     
     # don't really have to keep this one around at all
     _tube_conditions = Set(transient = True)
+    
+    # gate membership, packed one bit per event.  (see add_gate().)  
+    # BitSets are immutable, so clones can share them.
+    _gates = Dict(Str, Instance(BitSet), copy = "shallow")
+    
+    # per-channel transforms that haven't been applied to _data yet, and
+    # the filters that haven't dropped their events yet, as (channel, the
+    # channel's pending transform when the filter was added, threshold).
+    # (see transform_channel().)  Transforms are immutable, so clones can
+    # share them.
+    _pending_xforms = Dict(Str, Instance(Transform), copy = "shallow")
+    _pending_filters = List(Tuple(Str, Any, Float), copy = "shallow")
+    
+    # finalize() and _apply_pending() replace _data and clear the pending 
+    # work, and clone() copies them; the GUI may do these from different 
+    # threads.  re-entrant, because clone() finalizes while it holds it.
+    _lock = Instance(threading._RLock, factory = threading.RLock, 
+                     transient = True)
+    
+    # _data with the gates unpacked into bool columns.  built the first 
+    # time `data` is read, and thrown away when anything changes.
+    _gated_data = Instance(pd.DataFrame, transient = True)
+    
+    # the masks for the expressions passed to query(), as BitSets, most 
+    # recently used last.  thrown away when anything changes.  guarded by 
+    # _lock.
+    _query_masks = Instance(OrderedDict, (), transient = True)
+    
+    def _invalidate(self):
+        """Forget everything we computed from the events."""
+        with self._lock:
+            self._gated_data = None
+            self._query_masks.clear()
+        
+    def _get_nbytes(self):
+        frames = [self._data] + [data for data, _ in self._blocks]
+        nbytes = sum(getattr(frame[column].values, "nbytes", 0)
+                     for frame in frames
+                     for column in frame.columns)
+        return nbytes + sum(gate.nbytes for gate in self._gates.itervalues())
+        
+    def _get_columns(self):
+        self.finalize()
+        return list(self._data.columns) + list(self._gates)
+        
+    def _get_data(self):
+        self.finalize()
+        self._apply_pending()
+        
+        if not self._gates:
+            return self._data
+        
+        if self._gated_data is None:
+            self._gated_data = \
+                _replace_columns(self._data,
+                                 {name : gate.to_mask()
+                                  for name, gate in self._gates.iteritems()})
+            
+        return self._gated_data
+    
+    def _set_data(self, value):
+        self._blocks = []
+        self._pending_xforms = {}
+        self._pending_filters = []
+        self._invalidate()
+        
+        # re-pack the gates from any bool columns (ie, if an operation 
+        # filtered the events); forget the ones that are missing.
+        gates = [name for name in self._gates if name in value.columns]
+        self._gates = {name : BitSet(value[name].values) for name in gates}
+        if gates:
+            value = value.drop(gates, axis = 1)
+            
+        self._data = value
             
     def __getitem__(self, key):
-        """Override __getitem__ so we can reference columns like ex.column"""
+        """Override __getitem__ so we can reference columns like ex.column
+        
+        Only the gates that are asked for are unpacked; reading other 
+        columns doesn't build `data`.
+        """
+        self.finalize()
+        self._apply_pending()
+        
+        if isinstance(key, basestring):
+            if key in self._gates:
+                return pd.Series(self._gates[key].to_mask(),
+                                 index = self._data.index,
+                                 name = key)
+            return self._data[key]
+        
+        if isinstance(key, list) and not any(isinstance(k, basestring) and 
+                                             k in self._gates for k in key):
+            return self._data[key]
+        
         return self.data.__getitem__(key)
      
     def __setitem__(self, key, value):
-        """Override __setitem__ so we can assign columns like ex.column = ..."""
-        return self.data.__setitem__(key, value)
+        """Override __setitem__ so we can assign columns like ex.column = ...
+        
+        Channels are converted to `dtype`, whatever the operation computed 
+        them as.  If we have `storage`, numeric columns are copied to disk,
+        like the rest of the events.
+        
+        An existing column is replaced, not written over: its buffer may be 
+        shared with a clone (or be a read-only memory map, see `load()`.)
+        The other columns aren't copied.
+        
+        Assigning to a gate re-packs it.
+        """
+        self.finalize()
+        self._apply_pending()
+        self._invalidate()
+        
+        if key in self._gates:
+            self._gates[key] = BitSet(value)
+            return
+        
+        if key in self._data.columns or self.storage is not None:
+            # line a Series (or a scalar) up with the events, as pandas would
+            if isinstance(value, pd.Series) or np.ndim(value) == 0:
+                value = pd.Series(value, index = self._data.index)
+                
+        if key in self.channels and np.ndim(value) > 0:
+            if isinstance(value, pd.Series):
+                value = value.astype(self.dtype, copy = False)
+            else:
+                value = np.asarray(value).astype(self.dtype, copy = False)
+                
+        if self.storage is not None:
+            values = np.asarray(value)
+            if values.dtype.kind in "biuf":
+                value = self._allocate(len(values), values.dtype)
+                value[:] = values
+                
+        # pandas would copy a new column on disk into memory
+        if key in self._data.columns or isinstance(value, np.memmap):
+            self._data = _replace_columns(self._data, {key : value})
+        else:
+            self._data[key] = value
+            _pin(self._data)
+    
+    def add_gate(self, name, mask):
+        """Add a gate: a bool condition, stored one bit per event.
+        
+        Gating operations call this instead of adding a bool column to 
+        `data`; the gate is still a "bool" condition, and it still shows up 
+        as a column in `data` and in `query()`, but it's only unpacked when 
+        `data` is read.  Use `get_gate()` to combine gates without 
+        unpacking them.
+        
+        Parameters
+        ----------
+        name : Str
+            The name of the new condition.
+            
+        mask : array-like of bool
+            Whether each event is in the gate.
+            
+        Raises
+        ------
+        CytoflowError
+            If `name` is already a column, or if `mask` is the wrong length.
+        """
+        
+        self.finalize()
+        self._apply_pending()
+        
+        if name in self._gates or name in self._data.columns:
+            raise CytoflowError("Experiment already contains a column {0}"
+                                .format(name))
+            
+        if len(mask) != len(self._data.index):
+            raise CytoflowError("Gate {0} has {1} events, but the experiment "
+                                "has {2}"
+                                .format(name, len(mask), len(self._data.index)))
+        
+        self._gates[name] = BitSet(mask)
+        self._invalidate()
+        
+        self.conditions[name] = "bool"
+        self.metadata[name] = {}
+        
+    def get_gate(self, name):
+        """Get the BitSet for the gate `name`.
+        
+        Combine gates with `&`, `|`, `^` and `~`; then call 
+        `BitSet.to_mask()` to select events from `data`.
+        
+        Examples
+        --------
+        >>> mask = (ex.get_gate("CFP+") & ~ex.get_gate("RFP+")).to_mask()
+        >>> ex.data[mask]
+        """
+        if name not in self._gates:
+            raise CytoflowError("{0} isn't a gate".format(name))
+        
+        self._apply_pending()
+        return self._gates[name]
+    
+    def transform_channel(self, channel, xform):
+        """Transform a channel's events with a `Transform`.
+        
+        The transform isn't applied right away: it's composed with any other
+        transforms that are still pending for `channel`, and the whole chain 
+        is applied in one pass the next time the events are read.  So a
+        series of per-channel operations (autofluorescence correction, bead
+        calibration, then a logicle transform, say) only computes each 
+        channel once, instead of once per operation, and the intermediate
+        Experiments never compute their events at all unless something 
+        reads them.
+        
+        Because it is deferred, an error from `xform` (ie, a value outside 
+        its domain) would only be raised when the events are read, by 
+        whatever reads them.  So an operation whose transform can fail 
+        should check the values first, in `apply()` (see `pending_extent()`.)
+        
+        Parameters
+        ----------
+        channel : Str
+            The channel to transform.
+            
+        xform : Transform
+            The transform to apply to its (current) values.
+        """
+        
+        if channel not in self.channels:
+            raise CytoflowError("{0} isn't a channel".format(channel))
+        
+        if channel in self._pending_xforms:
+            xform = ComposedTransform([self._pending_xforms[channel], xform])
+            
+        self._pending_xforms[channel] = xform
+        self._invalidate()
+        
+    def keep_events_above(self, channel, threshold):
+        """Drop the events whose value of `channel` is <= `threshold`.
+        
+        Like `transform_channel()`, this is deferred until the events are 
+        read, and all the pending filters drop their events at once.  The 
+        filter uses `channel`'s value as of now, ie after the transforms 
+        that are already pending but not after ones added later.
+        
+        The remaining events are re-indexed from 0.
+        """
+        
+        if channel not in self.channels:
+            raise CytoflowError("{0} isn't a channel".format(channel))
+        
+        self._pending_filters.append((channel, 
+                                      self._pending_xforms.get(channel),
+                                      threshold))
+        self._invalidate()
+        
+    def pending_extent(self, channel):
+        """The smallest and largest values of `channel`, after the transforms
+        and filters that are pending -- but without applying them.
+        
+        Operations that add a transform with a limited domain use this to 
+        check the values in `apply()`.  It costs one (chunked) pass over 
+        the events; nothing is stored.
+        
+        Returns
+        -------
+        (float, float)
+            The minimum and maximum, ignoring NaNs; (nan, nan) if there 
+            aren't any events.
+        """
+        
+        if channel not in self.channels:
+            raise CytoflowError("{0} isn't a channel".format(channel))
+        
+        self.finalize()
+        
+        with self._lock:
+            data = self._data
+            xform = self._pending_xforms.get(channel)
+            filters = list(self._pending_filters)
+            
+        values = data[channel].values
+        n = len(values)
+        step = self.chunk_size if self.chunk_size > 0 else max(n, 1)
+        lo, hi = np.nan, np.nan
+        
+        for start in range(0, n, step):
+            check_cancelled()
+            stop = min(start + step, n)
+            
+            keep = np.ones(stop - start, dtype = np.bool_)
+            for f_channel, f_xform, threshold in filters:
+                f_values = data[f_channel].values[start:stop]
+                if f_xform is not None:
+                    f_values = f_xform(f_values)
+                with np.errstate(invalid = 'ignore'):
+                    keep &= np.asarray(f_values) > threshold
+                    
+            chunk = values[start:stop][keep]
+            if xform is not None:
+                chunk = np.asarray(xform(chunk))
+            chunk = chunk[~np.isnan(chunk)]
+            
+            if chunk.size:
+                lo = np.nanmin([lo, chunk.min()])
+                hi = np.nanmax([hi, chunk.max()])
+        
+        return (lo, hi)
+        
+    def apply_pending(self):
+        """Apply the pending transforms and filters now, instead of the next
+        time the events are read (ie, on another thread, so that reading 
+        them later is quick.)  Doesn't unpack the gates.
+        """
+        self.finalize()
+        self._apply_pending()
+        
+    def _apply_pending(self):
+        """
+        Apply the pending filters and transforms to _data, in one pass 
+        (and in chunks of `chunk_size` events)
+        """
+        
+        with self._lock:
+            if not self._pending_xforms and not self._pending_filters:
+                return
+        
+            data = self._data
+        
+            if self._pending_filters:
+                keep = np.ones(len(data.index), dtype = np.bool_)
+                for channel, xform, threshold in self._pending_filters:
+                    def above(keep, values, xform = xform, threshold = threshold):
+                        if xform is not None:
+                            values = xform(values)
+                        with np.errstate(invalid = 'ignore'):
+                            return keep & (np.asarray(values) > threshold)
+                    
+                    _map_chunks(above, [keep, data[channel].values], keep, 
+                                self.chunk_size)
+                    
+                # selecting rows copies the events we keep
+                if self.storage is not None:
+                    data = self.storage.take(data, keep)
+                else:
+                    data = data[keep]
+                    data.reset_index(drop = True, inplace = True)
+                gates = {name : BitSet(gate.to_mask()[keep])
+                         for name, gate in self._gates.iteritems()}
+            else:
+                gates = self._gates
+            
+            # if we're cancelled part-way through, _data must be untouched: so
+            # don't put the new columns in until they're all done
+            new_columns = {}
+            for channel, xform in self._pending_xforms.iteritems():
+                if self._pending_filters and self.storage is not None:
+                    # we just copied the events to disk, so nobody else has 
+                    # them: transform each column where it is, rather than 
+                    # allocating a new one
+                    values = data[channel].values
+                    _map_chunks(xform, [values], values, self.chunk_size)
+                else:
+                    values = self._allocate(len(data.index), self.dtype)
+                    new_columns[channel] = _map_chunks(xform, 
+                                                       [data[channel].values], 
+                                                       values, 
+                                                       self.chunk_size)
+            
+            # the columns that weren't transformed aren't copied
+            if new_columns:
+                data = _replace_columns(data, new_columns)
+            
+            self._data = data
+            self._gates = gates
+            self._pending_xforms = {}
+            self._pending_filters = []
+            self._invalidate()
+    
+    def _allocate(self, num_events, dtype):
+        """A new column, on disk if we have `storage`"""
+        if self.storage is not None:
+            return self.storage.allocate((num_events,), dtype)
+        else:
+            return np.empty(num_events, dtype = dtype)
+        
+    def map_events(self, fn, columns, dtype):
+        """Compute something for each event, `chunk_size` events at a time.
+        
+        Operations use this for elementwise computations, like gate 
+        membership or bin numbers, so that the temporaries stay bounded 
+        by `chunk_size` (see above.)
+        
+        Parameters
+        ----------
+        fn : callable
+            Called with one 1-D array per column in `columns`, each holding
+            the same (contiguous) range of events; returns an array with 
+            one result per event.
+            
+        columns : list(Str)
+            The columns to pass to `fn`.
+            
+        dtype : numpy dtype
+            The dtype of the results.
+            
+        Returns
+        -------
+        ndarray
+            The results, one per event.
+            
+        Examples
+        --------
+        >>> mask = ex.map_events(lambda x: x > 1000, ["FITC-A"], np.bool_)
+        """
+        
+        arrays = [self[c].values for c in columns]
+        out = np.empty(len(self._data.index), dtype = dtype)
+        return _map_chunks(fn, arrays, out, self.chunk_size)
     
     def query(self, expr, **kwargs):
         """Expose pandas.DataFrame.query() to the outside world
         NOTE: THIS WILL NOT WORK IF YOU ARE QUERYING WITH A LOCAL VARIABLE, YOU
               MUST DIRECTLY QUERY Experiment.data TO DO THAT!
+              
+        The expression is only evaluated once: the resulting mask is cached
+        (until the Experiment changes), so plotting the same subset again
+        just selects the events.  Passing any `kwargs` skips the cache.
         """
-        return self.data.query(expr, **kwargs)
+        
+        if kwargs:
+            return self.data.query(expr, **kwargs)
+        
+        self.finalize()
+        self._apply_pending()
+        
+        # the GUI queries from more than one thread
+        with self._lock:
+            data = self._data
+            mask = self._query_masks.pop(expr, None)
+            
+        if mask is None:
+            # only unpack the gates that the expression names
+            gates = {name : gate.to_mask() 
+                     for name, gate in self._gates.iteritems()
+                     if re.search(r"\b{0}\b".format(re.escape(name)), expr)}
+            if gates:
+                result = _replace_columns(data, gates).eval(expr)
+            else:
+                result = data.eval(expr)
+            if getattr(result, "dtype", None) != np.bool_:
+                raise CytoflowError("Subset {0} isn't a boolean expression"
+                                    .format(expr))
+            mask = BitSet(result)
+            
+        # most recently used last.  (unless the events changed meanwhile)
+        with self._lock:
+            if self._data is data:
+                self._query_masks[expr] = mask
+                while len(self._query_masks) > _QUERY_CACHE_SIZE:
+                    self._query_masks.popitem(last = False)
+            
+        # and the selected events' gate membership (only)
+        keep = mask.to_mask()
+        if not self._gates:
+            return data[keep]
+        
+        indices = np.flatnonzero(keep)
+        return _replace_columns(data[keep], 
+                                {name : gate.take(indices)
+                                 for name, gate in self._gates.iteritems()})
     
     def merge(self, other):
         """Merges some other experiment into this one. Conditions and channels must match.
@@ -164,13 +779,404 @@ class Experiment(HasStrictTraits):
         if self.channels != other.channels: 
             RuntimeError("This and other experiments do not have consistent channels")
             
-        self.data.append(other.data.copy())
+        data = other.data.copy()
+        for channel in self.channels:
+            data[channel] = data[channel].astype(self.dtype, copy = False)
+            
+        self._blocks.append((data, None))
         
     def clone(self):
-        """Clone this experiment"""
-        new_exp = self.clone_traits()
-        new_exp.data = self.data.copy()
+        """Clone this experiment
+        
+        The clone's data shares its column buffers with this Experiment.
+        Adding columns to either one doesn't copy anything, and changing a 
+        column (via `__setitem__`, or a pending transform) only replaces 
+        that column.  So an operation that only adds a column (like a gate), 
+        or only changes a few channels, doesn't copy the rest of the events.
+        """
+        with self._lock:
+            self.finalize()
+            new_exp = self.clone_traits()
+            new_exp._data = _replace_columns(self._data, {})
+        
+        # if an Experiment is cloned, it's probably done being operated on; 
+        # don't hang on to the unpacked gates.
+        self._gated_data = None
+        return new_exp
+
+    def nbytes_apart_from(self, other):
+        """Roughly how much memory the events use, in bytes, not counting 
+        the columns (or gates) this Experiment shares with `other`: ie, 
+        what it costs on top of the Experiment it was cloned from.  
+        
+        Channels with pending transforms count as this Experiment's, since 
+        they'll be replaced; if there are pending filters, all the columns 
+        do.
+        
+        Parameters
+        ----------
+        other : Experiment
+            The other Experiment.  If None, this is the same as `nbytes`.
+        """
+        
+        if other is None or self._blocks or self._pending_filters:
+            return self.nbytes
+        
+        # categorical columns' buffers are their codes
+        buffers = lambda frame: [getattr(frame[c].values, "codes", 
+                                         frame[c].values)
+                                 for c in frame.columns]
+        other_buffers = buffers(other._data)
+        
+        nbytes = 0
+        for column, values in zip(self._data.columns, buffers(self._data)):
+            if column in self._pending_xforms or \
+               not any(np.may_share_memory(values, other_values)
+                       for other_values in other_buffers):
+                nbytes += getattr(values, "nbytes", 0)
+                
+        # BitSets are immutable, so shared gates are the same object
+        other_gates = set(id(gate) for gate in other._gates.itervalues())
+        return nbytes + sum(gate.nbytes for gate in self._gates.itervalues()
+                            if id(gate) not in other_gates)
+
+    def subsample(self, events, seed = 0):
+        """A clone with an evenly spaced subset of this Experiment's events.
+
+        The subset is every (N / `events`)th event, starting at an offset 
+        chosen by `seed`: so it's spread across all the tubes (and across 
+        each tube's acquisition), and picking it costs nothing like a 
+        random choice from all N events.  For the same `seed` (and the same
+        events), the subset is the same every time, so whatever is computed
+        from it is repeatable.  The
+        events stay in order, and are re-indexed from 0.  Pending transforms
+        and filters are carried over and only applied to the subset (so a
+        pending filter may leave fewer than `events` events.)  The subset
+        is kept in memory, even if this Experiment has `storage`.
+
+        Parameters
+        ----------
+        events : Int
+            How many events to keep.  If the Experiment doesn't have more
+            than that, this is the same as `clone()`.
+
+        seed : Int (default = 0)
+            Chooses the offset of the first event.
+        """
+
+        new_exp = self.clone()
+
+        num_events = len(new_exp._data.index)
+        if num_events <= events:
+            return new_exp
+
+        # num_events > events, so the step is at least 1, and the last 
+        # index is at most offset + num_events - step < num_events
+        step = num_events // events
+        offset = seed % step
+        keep = offset + np.arange(events) * num_events // events
+
+        # selecting rows copies the events we keep
+        data = new_exp._data.take(keep)
+        data.reset_index(drop = True, inplace = True)
+        new_exp._data = data
+        new_exp._gates = {name : BitSet(gate.to_mask()[keep])
+                          for name, gate in new_exp._gates.iteritems()}
+        new_exp.storage = None
+        new_exp._invalidate()
+
+        return new_exp
+
+    def finalize(self):
+        """Concatenate the tubes added with add_tube() into Experiment.data.
+        
+        add_tube() doesn't append each tube to `data` as it is added (that
+        would copy the entire, growing DataFrame once per tube); instead, it
+        keeps a list of per-tube blocks and we concatenate them all at once,
+        the first time `data` is accessed.  You can also call finalize()
+        yourself, for example to control when the allocation happens.  It's
+        safe to call it more than once, and to add more tubes afterwards.
+        
+        This is also where the condition columns are built.  add_tube() only 
+        keeps one value per condition per tube, so the columns are filled
+        with numpy (and categorical conditions are built straight from their
+        codes) instead of from per-event lists of Python objects.
+        
+        Two threads may finalize the same Experiment at once (ie, the GUI 
+        plotting it while the next operation clones it): only one of them
+        concatenates the blocks, and the other waits for it.
+        """
+        
+        with self._lock:
+            if not self._blocks:
+                return
+            
+            self._finalize()
+            
+    def _finalize(self):
+        """finalize(), with the lock held"""
+        
+        if self._gates or self._pending_xforms or self._pending_filters:
+            raise CytoflowError("Can't add events to an Experiment that has "
+                                "already been gated or transformed")
+        
+        blocks = list(self._blocks)
+        
+        if len(self._data.columns) > 0:
+            blocks.insert(0, (self._data, None))
+        
+        # the categories for each categorical condition, in the order we 
+        # first saw them.  the blocks only ever get these categories, so
+        # we never have to re-categorize a block (or the whole frame.)
+        categories = {}
+        for meta_name, meta_type in self.conditions.iteritems():
+            if meta_type != "category":
+                continue
+            
+            cats = []
+            seen = set()
+            for data, conditions in blocks:
+                if conditions is None:
+                    block_cats = data[meta_name].cat.categories
+                else:
+                    block_cats = conditions[meta_name].cat.categories
+                    
+                for cat in block_cats:
+                    if cat not in seen:
+                        seen.add(cat)
+                        cats.append(cat)
+                        
+            categories[meta_name] = cats
+            
+        new_blocks = []
+        for data, conditions in blocks:
+            # don't add columns to a frame someone else might be holding
+            data = _replace_columns(data, {})
+            
+            if conditions is None:
+                for meta_name, cats in categories.iteritems():
+                    data[meta_name] = data[meta_name].cat.set_categories(cats)
+            else:
+                # one value per tube: build the column with numpy instead
+                # of from a per-event list of Python objects
+                for meta_name, meta_value in conditions.iteritems():
+                    if meta_name in categories:
+                        code = categories[meta_name].index(meta_value.iloc[0])
+                        codes = np.empty(len(data.index), dtype = np.int32)
+                        codes.fill(code)
+                        data[meta_name] = \
+                            pd.Categorical.from_codes(codes,
+                                                      categories[meta_name])
+                    else:
+                        data[meta_name] = np.repeat(meta_value.values, 
+                                                    len(data.index))
+                        
+            new_blocks.append(data)
+            
+        if self.storage is not None:
+            self._data = _pin(self.storage.concat(new_blocks,
+                                                  {channel : self.dtype
+                                                   for channel in 
+                                                   self.channels}))
+        else:
+            self._data = pd.concat(new_blocks, ignore_index = True)
+            
+        # only now, so that if we're cancelled part-way through, we can 
+        # start over
+        self._blocks = []
+        self._invalidate()
+        
+    def save(self, path):
+        """Save the Experiment to the directory `path`, for `load()`.
+        
+        The events are saved as .npy files, one per dtype, with the columns 
+        laid out one after the other; the channels, conditions, column 
+        layout and metadata are saved as JSON in `experiment.json`.  (Any
+        metadata that can't be written as JSON, like transforms, is 
+        pickled into `metadata.pickle`.)  The categories of categorical 
+        conditions are pickled into `categories.pickle`, so they keep their 
+        types.  Gates are saved packed.
+        
+        Parameters
+        ----------
+        path : Str
+            The directory to save to.  It's created if it doesn't exist; 
+            files already in it are overwritten.
+        """
+        
+        self.finalize()
+        self._apply_pending()
+        data = self._data
+        num_events = len(data.index)
+        
+        if not os.path.isdir(path):
+            os.makedirs(path)
+            
+        header = {"format" : _FILE_FORMAT,
+                  "version" : _FILE_VERSION,
+                  "dtype" : self.dtype,
+                  "num_events" : num_events,
+                  "channels" : list(self.channels),
+                  "conditions" : dict(self.conditions),
+                  "blocks" : [],
+                  "categories" : [],
+                  "gates" : {},
+                  "metadata" : {}}
+        
+        # group the columns by dtype.  categorical columns are saved as
+        # their codes.
+        groups = OrderedDict()
+        categories = {}
+        for column in data.columns:
+            values = data[column]
+            if str(values.dtype) == "category":
+                header["categories"].append(column)
+                categories[column] = list(values.cat.categories)
+                values = values.cat.codes
+            groups.setdefault(values.dtype.str, []).append((column, 
+                                                            values.values))
+            
+        for idx, (dtype, columns) in enumerate(groups.iteritems()):
+            filename = "columns-{0}.npy".format(idx)
+            
+            # write the columns straight into the file, one at a time
+            if num_events > 0:
+                block = np.lib.format.open_memmap(os.path.join(path, filename),
+                                                  mode = 'w+',
+                                                  dtype = dtype,
+                                                  shape = (len(columns), 
+                                                           num_events))
+                for row, (_, values) in enumerate(columns):
+                    block[row] = values
+                block.flush()
+                del block
+            else:
+                np.save(os.path.join(path, filename),
+                        np.empty((len(columns), 0), dtype = dtype))
+                
+            header["blocks"].append({"file" : filename,
+                                     "columns" : [c for c, _ in columns]})
+            
+        for idx, (name, gate) in enumerate(self._gates.iteritems()):
+            filename = "gate-{0}.bits".format(idx)
+            with open(os.path.join(path, filename), 'wb') as f:
+                f.write(gate.to_bytes())
+            header["gates"][name] = {"file" : filename, 
+                                     "length" : len(gate)}
+            
+        extra = {}
+        for column, column_meta in self.metadata.iteritems():
+            header["metadata"][column] = {}
+            for key, value in column_meta.iteritems():
+                try:
+                    json.dumps(value)
+                except (TypeError, ValueError):
+                    extra.setdefault(column, {})[key] = value
+                else:
+                    header["metadata"][column][key] = value
+                
+        for filename, contents in [(_METADATA_FILE, extra),
+                                   (_CATEGORIES_FILE, categories)]:
+            filename = os.path.join(path, filename)
+            if contents:
+                with open(filename, 'wb') as f:
+                    pickle.dump(contents, f, pickle.HIGHEST_PROTOCOL)
+            elif os.path.exists(filename):
+                os.remove(filename)
+            
+        with open(os.path.join(path, _HEADER_FILE), 'w') as f:
+            json.dump(header, f, indent = 2)
+            
+    @classmethod
+    def load(cls, path):
+        """Load an Experiment saved with `save()`.
+        
+        The events are memory-mapped, not read, so loading takes about the 
+        same time however many events there are.  The mapping is read-only:
+        changing a column replaces it, as for a clone.
+        
+        Parameters
+        ----------
+        path : Str
+            The directory the Experiment was saved to.
+            
+        Returns
+        -------
+        Experiment
+        
+        Raises
+        ------
+        CytoflowError
+            If `path` doesn't hold a saved Experiment.
+        """
+        
+        try:
+            with open(os.path.join(path, _HEADER_FILE), 'r') as f:
+                header = _from_json(json.load(f))
+        except (IOError, ValueError) as e:
+            raise CytoflowError("Can't read an experiment from {0}: {1}"
+                                .format(path, e))
+            
+        if header.get("format") != _FILE_FORMAT:
+            raise CytoflowError("{0} isn't a saved experiment".format(path))
+        
+        if header.get("version") != _FILE_VERSION:
+            raise CytoflowError("{0} was saved in an unsupported format "
+                                "(version {1})"
+                                .format(path, header.get("version")))
+            
+        num_events = header["num_events"]
+        
+        new_exp = cls(dtype = header["dtype"])
+        new_exp.channels = header["channels"]
+        new_exp.conditions = header["conditions"]
+        
+        metadata = header["metadata"]
+        metadata_file = os.path.join(path, _METADATA_FILE)
+        if os.path.exists(metadata_file):
+            with open(metadata_file, 'rb') as f:
+                for column, column_meta in pickle.load(f).iteritems():
+                    metadata.setdefault(column, {}).update(column_meta)
+        new_exp.metadata = metadata
+        
+        parts = []
+        for block in header["blocks"]:
+            values = np.load(os.path.join(path, block["file"]),
+                             mmap_mode = 'r' if num_events > 0 else None)
+            
+            # a frame made from a 2-D array wraps it without copying
+            parts.append(pd.DataFrame(values.T, 
+                                      columns = block["columns"],
+                                      copy = False))
+            
+        if not parts:
+            data = pd.DataFrame(index = range(num_events))
+        elif len(parts) == 1:
+            data = parts[0]
+        else:
+            data = pd.concat(parts, axis = 1, copy = False)
+            
+        # replace the codes, rather than converting them in place: that 
+        # would copy the rest of their block into memory
+        if header["categories"]:
+            with open(os.path.join(path, _CATEGORIES_FILE), 'rb') as f:
+                categories = pickle.load(f)
+            data = _replace_columns(data, 
+                {column : pd.Categorical.from_codes(data[column].values, 
+                                                    categories[column])
+                 for column in header["categories"]})
+            
+        for name, gate in header["gates"].iteritems():
+            with open(os.path.join(path, gate["file"]), 'rb') as f:
+                new_exp._gates[name] = BitSet.from_bytes(f.read(), 
+                                                         gate["length"])
+            
+        new_exp._data = data
         return new_exp
+        
+    def __getstate__(self):
+        self.finalize()
+        return super(Experiment, self).__getstate__()
             
     def add_conditions(self, conditions):
         """Add one or more conditions as a dictionary. Call before adding tubes.
@@ -209,7 +1215,10 @@ class Experiment(HasStrictTraits):
         """Add an FCMeasurement, and its experimental conditions, to this Experiment.
         
         Remember: because add_tube COPIES the data into this Experiment, you can
-        DELETE the tube after you add it (and save memory)
+        DELETE the tube after you add it (and save memory).  The copy happens
+        in finalize(); until then, the Experiment holds on to the tube's
+        events (which may be memory-mapped, if the tube came from
+        `cytoflow.utility.parse_fcs()`.)
         
         Parameters
         ----------
@@ -239,9 +1248,6 @@ class Experiment(HasStrictTraits):
         >>> ex.add_tube(tube1, {"Time" : 1, "Strain" : "BL21"})
         >>> ex.add_tube(tube2, {"Time" : 1, "Strain" : "Top10G"})
         """
-<<<<<<< HEAD
-        
-=======
 
         tube_meta, tube_data = tube
         
@@ -252,7 +1258,6 @@ class Experiment(HasStrictTraits):
         tube_channels = tube_meta["_channels_"].set_index("$PnN")    
         tube_file = tube_meta["$FIL"]   
     
->>>>>>> refs/remotes/bpteague/master
         if(self.channels):
             # first, make sure the new tube's channels match the rest of the 
             # channels in the Experiment
@@ -310,23 +1315,11 @@ class Experiment(HasStrictTraits):
         if frozenset(conditions.iteritems()) in self._tube_conditions:
             raise CytoflowError("Tube {0} has non-unique conditions".format(tube_file))
                 
-        # add the conditions to tube's internal data frame.  specify the conditions
-        # dtype using self.conditions.  check for errors as we do so.
-        
-        # take this chance to up-convert the float32s to float64.
-        # this happened automatically in DataFrame.append(), below, but 
-        # only in certain cases.... :-/
-        
-        # TODO - the FCS standard says you can specify the precision.  
-        # check with int/float/double files!
-        
-<<<<<<< HEAD
-        new_data = tube.data.astype("float64", copy=True)
-        new_data["Tube"] = tube.ID
-=======
-        new_data = tube_data.astype("float64", copy=True)
->>>>>>> refs/remotes/bpteague/master
+        # convert the conditions to the dtypes in self.conditions.  check for 
+        # errors as we do so.  we only keep one value per condition per tube;
+        # finalize() builds the condition columns.
         
+        tube_conditions = {}
         for meta_name, meta_value in conditions.iteritems():
             if(meta_name not in self.conditions):
                 raise CytoflowError("Tube {0} asked to add conditions {1} which" \
@@ -334,16 +1327,8 @@ class Experiment(HasStrictTraits):
                                    .format(tube_file, meta_name))
             meta_type = self.conditions[meta_name]
             try:
-                new_data[meta_name] = \
-                    pd.Series(data = [meta_value] * len(tube_data.index),
-                              index = new_data.index,
-                              dtype = meta_type)
-                
-                # if we're categorical, merge the categories
-                if meta_type == "category" and meta_name in self.data.columns:
-                    cats = set(self.data[meta_name].cat.categories) | set(new_data[meta_name].cat.categories)
-                    self.data[meta_name] = self.data[meta_name].cat.set_categories(cats)
-                    new_data[meta_name] = new_data[meta_name].cat.set_categories(cats)
+                tube_conditions[meta_name] = pd.Series(data = [meta_value],
+                                                       dtype = meta_type)
             except (ValueError, TypeError):
                 raise CytoflowError("Tube {0} had trouble converting conditions {1}"
                                    "(value = {2}) to type {3}" \
@@ -352,9 +1337,26 @@ class Experiment(HasStrictTraits):
                                            meta_value,
                                            meta_type))
         
+        # take this chance to convert the events to self.dtype.  (they're 
+        # usually float32s; by default, we up-convert to float64.)
+        
+        # TODO - the FCS standard says you can specify the precision.  
+        # check with int/float/double files!
+        
+        # don't copy the events unless we're converting them: finalize() 
+        # makes the one copy we need when it concatenates the tubes.  (if
+        # we have `storage`, that copy converts them as it writes them to 
+        # disk, so don't make an in-memory copy here.)
+        if self.storage is not None:
+            new_data = tube_data
+        else:
+            new_data = tube_data.astype(self.dtype, copy = False)
+        
         self._tube_conditions.add(frozenset(conditions.iteritems()))
-        self.data = self.data.append(new_data, ignore_index = True)
-        del new_data
+        
+        # don't append to self.data here -- that copies the whole frame for
+        # every tube.  finalize() concatenates the blocks all at once.
+        self._blocks.append((new_data, tube_conditions))
 
 
 if __name__ == "__main__":
@@ -10,9 +10,6 @@ from polygon import PolygonOp
 
 # transforms
 from hlog import HlogTransformOp
-<<<<<<< HEAD
-# from logicle import LogicleTransformOp
-=======
 from logicle import LogicleTransformOp
 from log import LogTransformOp
 
@@ -22,4 +19,3 @@ from bead_calibration import BeadCalibrationOp
 from color_translation import ColorTranslationOp
 
 from binning import BinningOp
->>>>>>> refs/remotes/bpteague/master
@@ -7,7 +7,7 @@ import fcsparser
 
 from cytoflow.operations import IOperation
 from cytoflow.views import IView
-from cytoflow.utility import CytoflowOpError
+from cytoflow.utility import CytoflowOpError, LinearTransform
 
 @provides(IOperation)
 class AutofluorescenceOp(HasStrictTraits):
@@ -95,9 +95,11 @@ class AutofluorescenceOp(HasStrictTraits):
             if blank_v != v:
                 raise CytoflowOpError("Voltage differs for channel {0}".format(channel)) 
        
+        # FCS files usually store float32s; accumulate in float64
         for channel in self.channels:
-            self._af_median[channel] = np.median(blank_data[channel])
-            self._af_stdev[channel] = np.std(blank_data[channel])    
+            channel_data = blank_data[channel].astype(np.float64)
+            self._af_median[channel] = np.median(channel_data)
+            self._af_stdev[channel] = np.std(channel_data)
                 
     def apply(self, experiment):
         """Applies the threshold to an experiment.
@@ -132,8 +134,8 @@ class AutofluorescenceOp(HasStrictTraits):
         new_experiment = experiment.clone()
                 
         for channel in self.channels:
-            new_experiment[channel] = \
-                experiment[channel] - self._af_median[channel]
+            new_experiment.transform_channel(
+                channel, LinearTransform(offset = -self._af_median[channel]))
                 
             # add the AF values to the channel's metadata, so we can correct
             # other controls (etc) later on
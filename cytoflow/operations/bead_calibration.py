@@ -18,7 +18,8 @@ import matplotlib.pyplot as plt
 
 from cytoflow.operations import IOperation
 from cytoflow.views import IView
-from cytoflow.utility import CytoflowOpError, CytoflowViewError
+from cytoflow.utility import CytoflowOpError, CytoflowViewError, parse_fcs, \
+                             LinearTransform, PowerTransform
 
 @provides(IOperation)
 class BeadCalibrationOp(HasStrictTraits):
@@ -298,16 +299,13 @@ class BeadCalibrationOp(HasStrictTraits):
         new_experiment = experiment.clone()
         
         for channel in channels:
-            new_experiment.data = \
-                new_experiment.data[new_experiment.data[channel] > 0]
-                
-        new_experiment.data.reset_index(drop = True, inplace = True)
+            new_experiment.keep_events_above(channel, 0)
         
         for channel in channels:
             if len(self._coefficients[channel]) == 1:
                 # plain old multiplication
                 a = self._coefficients[channel][0]
-                calibration_fn = lambda x, a=a: a * x
+                calibration_fn = LinearTransform(scale = a)
             else:
                 # remember, these (linear) coefficients came from logspace, so 
                 # if the relationship in log10 space is Y = aX + b, then in
@@ -319,9 +317,9 @@ class BeadCalibrationOp(HasStrictTraits):
                 # solve y=ax + b, coeff #0 is a and coeff #1 is b
                 a = self._coefficients[channel][0]
                 b = 10 ** self._coefficients[channel][1]
-                calibration_fn = lambda x, a=a, b=b: b * np.power(x, a)
+                calibration_fn = PowerTransform(a = a, b = b)
     
-            new_experiment[channel] = calibration_fn(new_experiment[channel])
+            new_experiment.transform_channel(channel, calibration_fn)
             new_experiment.metadata[channel]['bead_calibration_fn'] = calibration_fn
             new_experiment.metadata[channel]['units'] = self.units[channel]
             new_experiment.metadata[channel]['range'] = calibration_fn(experiment.metadata[channel]['range'])
@@ -339,12 +337,10 @@ class BeadCalibrationOp(HasStrictTraits):
         """
         
         try:
-            _ = fcsparser.parse(self.beads_file, 
-                                meta_data_only = True, 
-                                reformat_meta = True)
+            _ = parse_fcs(self.beads_file, meta_data_only = True)
         except Exception as e:
             raise CytoflowOpError("FCS reader threw an error on tube {0}: {1}"\
-                               .format(self.beads_file, e.value))
+                               .format(self.beads_file, e))
 
         return BeadCalibrationDiagnostic(op = self)
     
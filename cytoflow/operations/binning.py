@@ -95,11 +95,11 @@ class BinningOp(HasStrictTraits):
         if not self.name:
             raise CytoflowOpError("name is not set")
         
-        if self.name in experiment.data.columns:
+        if self.name in experiment.columns:
             raise CytoflowOpError("name {0} is in the experiment already"
                                   .format(self.name))
             
-        if self.bin_count_name and self.bin_count_name in experiment.data.columns:
+        if self.bin_count_name and self.bin_count_name in experiment.columns:
             raise CytoflowOpError("bin_count_name {0} is in the experiment already"
                                   .format(self.bin_count_name))
         
@@ -113,8 +113,8 @@ class BinningOp(HasStrictTraits):
         if self.num_bins is Undefined and self.bin_width is Undefined:
             raise CytoflowOpError("must set either bin number or width")  
             
-        channel_min = experiment.data[self.channel].min()
-        channel_max = experiment.data[self.channel].max()
+        channel_min = experiment[self.channel].min()
+        channel_max = experiment[self.channel].max()
         
         if self.scale == "linear":
             num_bins = self.num_bins if self.num_bins is not Undefined else \
@@ -133,16 +133,17 @@ class BinningOp(HasStrictTraits):
         bins = bins[1:-1]
             
         new_experiment = experiment.clone()
-        new_experiment[self.name] = np.digitize(experiment[self.channel], bins)
+        new_experiment[self.name] = \
+            new_experiment.map_events(lambda x: np.digitize(x, bins),
+                                      [self.channel],
+                                      np.intp)
         
         new_experiment.conditions[self.name] = "int"
         new_experiment.metadata[self.name] = {}
         new_experiment.metadata[self.name]["bins"] = bins
         
         if self.bin_count_name:
-            # TODO - this is a HUGE memory hog?!
-            agg_count = new_experiment.data.groupby(self.name).count()
-            agg_count = agg_count[agg_count.columns[0]]
+            agg_count = new_experiment[self.name].value_counts()
             new_experiment[self.bin_count_name] = \
                 new_experiment[self.name].map(agg_count)
             new_experiment.conditions[self.bin_count_name] = "int"
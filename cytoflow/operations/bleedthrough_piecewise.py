@@ -8,11 +8,12 @@ from __future__ import division
 
 from traits.api import HasStrictTraits, Str, CStr, File, Dict, Python, \
                        Instance, Int, List, Constant, provides
+import multiprocessing
+
 import numpy as np
 import math
 import scipy.interpolate
 import scipy.optimize
-import pandas
 import fcsparser
 
 import matplotlib.pyplot as plt
@@ -20,7 +21,8 @@ import matplotlib.pyplot as plt
 from cytoflow.operations.i_operation import IOperation
 from cytoflow.operations.hlog import hlog, hlog_inv
 from cytoflow.views import IView
-from cytoflow.utility import CytoflowOpError, cartesian
+from cytoflow.utility import CytoflowOpError, PositiveInt, cartesian, \
+                             parse_fcs, check_cancelled
 
 @provides(IOperation)
 class BleedthroughPiecewiseOp(HasStrictTraits):
@@ -58,6 +60,14 @@ class BleedthroughPiecewiseOp(HasStrictTraits):
     mesh_size : Int (default = 32)
         The size of each axis in the mesh used to interpolate corrected values.
         
+    workers : Int (default = 1)
+        How many processes to use to correct the mesh in `estimate()`.  If 
+        `workers > 1`, the mesh is split into chunks that are solved by a 
+        pool of worker processes (each of which gets the splines once, when 
+        it starts); the results are put back together in mesh order, so 
+        they're the same as with one worker.  Worth it for 4 or more 
+        channels, where the mesh has `mesh_size ** channels` points.
+        
     Notes
     -----
     We use an interpolation-based scheme to estimate corrected bleedthrough.
@@ -73,9 +83,10 @@ class BleedthroughPiecewiseOp(HasStrictTraits):
        instrument, estimate the mapping from (raw colors) --> (actual colors).
        The mesh points are also distributed evenly along the hlog-transformed
        color axes; this captures negative data as well as positive 
-       This is quite slow: ~30 seconds for a mesh size of 32 in 3-space.
-       Remember that additional channels expand the number of mesh points
-       exponentially!
+       All the mesh points are solved together, with a vectorized Newton
+       iteration (see `_correct_bleedthrough()`), so a mesh size of 32 in
+       3-space takes well under a second.  Remember that additional channels
+       expand the number of mesh points exponentially!
 
      - Use these estimates to paramaterize a linear interpolator (in linear
        space, this time).  There's one interpolator per output channel (so
@@ -107,10 +118,14 @@ class BleedthroughPiecewiseOp(HasStrictTraits):
     controls = Dict(Str, File)
     num_knots = Int(7)
     mesh_size = Int(32)
+    workers = PositiveInt(1)
 
     _splines = Dict(Str, Dict(Str, Python))
     _interpolators = Dict(Str, Python)
     
+    # all the channels' corrected meshes, in one _GridInterpolator
+    _interpolator = Python
+    
     # because the order of the channels is important, we can't just call
     # _interpolators.keys()
     _channels = List(Str)
@@ -129,13 +144,12 @@ class BleedthroughPiecewiseOp(HasStrictTraits):
     
         for channel in self._channels:
             try:
-                tube_meta = fcsparser.parse(self.controls[channel], 
-                                            meta_data_only = True, 
-                                            reformat_meta = True)
+                tube_meta = parse_fcs(self.controls[channel], 
+                                      meta_data_only = True)
                 tube_channels = tube_meta["_channels_"].set_index("$PnN")
             except Exception as e:
                 raise CytoflowOpError("FCS reader threw an error on tube {0}: {1}"\
-                                   .format(self.controls[channel], e.value))
+                                   .format(self.controls[channel], e))
 
             for channel in self._channels:
                 exp_v = experiment.metadata[channel]['voltage']
@@ -223,18 +237,44 @@ class BleedthroughPiecewiseOp(HasStrictTraits):
                                                           k = 1)
          
         
-        mesh = pandas.DataFrame(cartesian(mesh_axes), 
-                                columns = [x for x in self._channels])
-         
-        mesh_corrected = mesh.apply(_correct_bleedthrough,
-                                    axis = 1,
-                                    args = ([[x for x in self._channels], 
-                                             self._splines]))
+        mesh = cartesian(mesh_axes)
         
-        for channel in self._channels:
-            chan_values = np.reshape(mesh_corrected[channel], [len(x) for x in mesh_axes])
+        # plain containers pickle more cheaply than trait containers
+        channels = list(self._channels)
+        splines = {from_channel : dict(to_splines) 
+                   for from_channel, to_splines in self._splines.iteritems()}
+        
+        if self.workers > 1 and len(mesh) > self.workers:
+            # a few chunks per worker, to even out the load.  map() returns
+            # the chunks in order.
+            chunks = np.array_split(mesh, self.workers * 4)
+            pool = multiprocessing.Pool(processes = self.workers,
+                                        initializer = _init_worker,
+                                        initargs = (channels, splines))
+            try:
+                mesh_corrected = \
+                    np.concatenate(pool.map(_correct_bleedthrough_chunk, 
+                                            chunks))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            mesh_corrected = _correct_bleedthrough(mesh, channels, splines)
+        
+        for idx, channel in enumerate(self._channels):
+            chan_values = np.reshape(mesh_corrected[:, idx], 
+                                     [len(x) for x in mesh_axes])
             self._interpolators[channel] = \
                 scipy.interpolate.RegularGridInterpolator(mesh_axes, chan_values)
+                
+        self._interpolator = \
+            _GridInterpolator(mesh_axes, 
+                              np.reshape(mesh_corrected,
+                                         [len(x) for x in mesh_axes] + 
+                                         [len(self._channels)]))
 
         # TODO - some sort of validity checking.
 
@@ -266,15 +306,14 @@ class BleedthroughPiecewiseOp(HasStrictTraits):
         # (-3 * autofluorescence sigma)
         for channel in self._channels:
             af_stdev = new_experiment.metadata[channel]['af_stdev']
-            new_experiment.data = \
-                new_experiment.data[new_experiment.data[channel] > -3 * af_stdev]
+            new_experiment.keep_events_above(channel, -3 * af_stdev)
         
-        new_experiment.data.reset_index(drop = True, inplace = True)
+        # correct all the channels at once: each event's mesh cell is only
+        # located once
+        corrected = self._interpolator(new_experiment[self._channels].values)
         
-        old_data = new_experiment.data[self._channels]
-        
-        for channel in self._channels:
-            new_experiment[channel] = self._interpolators[channel](old_data)
+        for idx, channel in enumerate(self._channels):
+            new_experiment[channel] = corrected[:, idx]
             
             # add the correction splines to the experiment metadata so we can 
             # correct other controls later on
@@ -301,37 +340,206 @@ class BleedthroughPiecewiseOp(HasStrictTraits):
         # make sure we can get the control tubes to plot the diagnostic
         for channel in channels:       
             try:
-                _ = fcsparser.parse(self.controls[channel], 
-                                    meta_data_only = True, 
-                                    reformat_meta = True)
+                _ = parse_fcs(self.controls[channel], meta_data_only = True)
             except Exception as e:
                 raise CytoflowOpError("FCS reader threw an error on tube {0}: {1}"\
-                                   .format(self.controls[channel], e.value))
+                                   .format(self.controls[channel], e))
 
         return BleedthroughPiecewiseDiagnostic(op = self)
     
-# module-level "static" function (doesn't require a class instance)
-def _correct_bleedthrough(row, channels, splines):
-    idx = {channel : idx for idx, channel in enumerate(channels)}
+# how many events _GridInterpolator works on at a time
+_INTERPOLATE_CHUNK_SIZE = 1 << 16
+
+class _GridInterpolator(object):
+    """
+    Multilinear interpolation on a rectilinear grid, with several outputs.
     
-    def channel_error(x, channel):
-        ret = row[channel] - x[idx[channel]]
-        for from_channel in [c for c in channels if c != channel]:
-            ret -= splines[from_channel][channel](x[idx[from_channel]])
-        return ret
+    Like one `scipy.interpolate.RegularGridInterpolator` per output, but
+    each point's grid cell (and its interpolation weights) are only 
+    computed once and shared by all the outputs.  The points are processed
+    in chunks, so the temporaries stay small.
     
-    def row_error(x):
-        ret = [channel_error(x, channel) for channel in channels]
-        return ret
+    Parameters
+    ----------
+    axes : list of 1-D ndarray
+        The (increasing) grid coordinates along each dimension.
+        
+    values : ndarray
+        The outputs at each grid point; its shape is the lengths of `axes`, 
+        plus one more dimension for the outputs.
+    """
+    
+    def __init__(self, axes, values):
+        self.axes = [np.asarray(axis, dtype = np.float64) for axis in axes]
+        shape = tuple(len(axis) for axis in self.axes)
+        
+        values = np.asarray(values, dtype = np.float64)
+        if values.shape[:-1] != shape:
+            raise ValueError("values has shape {0}, but the grid is {1}"
+                             .format(values.shape, shape))
+        
+        self.values = values.reshape((-1, values.shape[-1]))
+        
+        # the offset (in grid points) of a step along each dimension
+        self.strides = np.cumprod((shape + (1,))[:0:-1])[::-1]
+        
+    def __call__(self, points):
+        """
+        Interpolate at `points` (one row per point, one column per 
+        dimension); return an array with one row per point and one column 
+        per output.  Raises ValueError if any point is outside the grid.
+        """
+        
+        points = np.asarray(points, dtype = np.float64)
+        out = np.empty((len(points), self.values.shape[1]))
+        
+        for start in range(0, len(points), _INTERPOLATE_CHUNK_SIZE):
+            check_cancelled()
+            stop = start + _INTERPOLATE_CHUNK_SIZE
+            out[start:stop] = self._interpolate(points[start:stop])
+            
+        return out
+    
+    def _interpolate(self, points):
+        base = np.zeros(len(points), dtype = np.intp)
+        fracs = []
+        
+        for dim, axis in enumerate(self.axes):
+            x = points[:, dim]
+            if np.any(x < axis[0]) or np.any(x > axis[-1]):
+                raise ValueError("One of the requested points is out of "
+                                 "bounds in dimension {0}".format(dim))
+            
+            idx = np.searchsorted(axis, x, side = 'right') - 1
+            np.clip(idx, 0, len(axis) - 2, out = idx)
+            
+            fracs.append((x - axis[idx]) / (axis[idx + 1] - axis[idx]))
+            base += idx * self.strides[dim]
+            
+        # sum the outputs at each corner of the cell, weighted by the 
+        # volume of the opposite sub-cell
+        result = np.zeros((len(points), self.values.shape[1]))
+        for corner in range(1 << len(self.axes)):
+            weight = np.ones(len(points))
+            offset = 0
+            for dim, frac in enumerate(fracs):
+                if corner & (1 << dim):
+                    weight *= frac
+                    offset += self.strides[dim]
+                else:
+                    weight *= 1 - frac
+                    
+            result += weight[:, np.newaxis] * self.values[base + offset]
+            
+        return result
+        
+# module-level "static" functions (don't require a class instance)
+def _correct_bleedthrough(mesh, channels, splines, tol = 1.49012e-08, 
+                          max_iter = 50):
+    """
+    Find the actual colors x that produce the measured colors y at each mesh
+    point, ie solve
+    
+        y[c] = x[c] + sum(splines[f][c](x[f]) for each other channel f)
+        
+    for every row of `mesh` at once.  Each Newton step evaluates the splines
+    (and their derivatives, for the Jacobian) on whole columns and solves
+    all the mesh points' (small) linear systems in one call to 
+    `np.linalg.solve`.  The splines are piecewise-linear, so this usually 
+    converges in a few steps; any mesh points that don't (or whose Jacobian
+    is singular) are handed to `scipy.optimize.root`, one at a time.
+    
+    Parameters
+    ----------
+    mesh : ndarray
+        The measured colors, one row per mesh point and one column per 
+        channel (in the order of `channels`.)
+        
+    channels : list(Str)
+        The channels.
+        
+    splines : dict(Str : dict(Str : spline))
+        The bleedthrough splines, from channel --> to channel.
+        
+    Returns
+    -------
+    ndarray
+        The corrected colors, the same shape as `mesh`.
+    """
+    
+    y = np.asarray(mesh, dtype = np.float64)
+    n = len(channels)
+    
+    x = y.copy()
+    active = np.arange(len(y))
+    singular = []
     
-    x_0 = row.loc[channels].convert_objects(convert_numeric = True)
-    x = scipy.optimize.root(row_error, x_0)
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        
+        xa = x[active]
+        resid = y[active] - xa
+        jac = np.zeros((len(active), n, n))
+        
+        for to_idx, to_channel in enumerate(channels):
+            jac[:, to_idx, to_idx] = -1.0
+            for from_idx, from_channel in enumerate(channels):
+                if from_idx == to_idx:
+                    continue
+                
+                spline = splines[from_channel][to_channel]
+                resid[:, to_idx] -= spline(xa[:, from_idx])
+                jac[:, to_idx, from_idx] = -spline(xa[:, from_idx], nu = 1)
+                
+        # the points whose Jacobian is singular go to the fallback; the
+        # others carry on (np.linalg.solve() would fail for all of them.)
+        # the determinant is the product of the LU factorization's pivots,
+        # so it's 0 exactly when solve() would find a zero pivot.
+        det = np.linalg.det(jac)
+        ok = np.isfinite(det) & (det != 0)
+        if not ok.all():
+            singular.append(active[~ok])
+            active, xa, jac, resid = active[ok], xa[ok], jac[ok], resid[ok]
+            if len(active) == 0:
+                break
+            
+        step = np.linalg.solve(jac, resid[:, :, np.newaxis])[:, :, 0]
+        
+        x[active] = xa - step
+        
+        done = np.all(np.abs(step) <= tol * (1 + np.abs(xa)), axis = 1)
+        active = active[~done]
     
-    ret = row.copy()
-    for idx, channel in enumerate(channels):
-        ret[channel] = x.x[idx]
+    for i in np.concatenate(singular + [active]):
+        x[i] = _correct_bleedthrough_point(y[i], channels, splines)
         
-    return ret
+    return x
+
+# the channels and splines, in a worker process (see estimate())
+_worker_channels = None
+_worker_splines = None
+
+def _init_worker(channels, splines):
+    global _worker_channels, _worker_splines
+    _worker_channels = channels
+    _worker_splines = splines
+
+def _correct_bleedthrough_chunk(mesh):
+    return _correct_bleedthrough(mesh, _worker_channels, _worker_splines)
+
+def _correct_bleedthrough_point(y, channels, splines):
+    """Solve for one mesh point with scipy.optimize.root"""
+    
+    def point_error(x):
+        ret = y - x
+        for to_idx, to_channel in enumerate(channels):
+            for from_idx, from_channel in enumerate(channels):
+                if from_idx != to_idx:
+                    ret[to_idx] -= splines[from_channel][to_channel](x[from_idx])
+        return ret
+    
+    return scipy.optimize.root(point_error, y).x
         
 @provides(IView)
 class BleedthroughPiecewiseDiagnostic(HasStrictTraits):
@@ -16,7 +16,7 @@ import sklearn.mixture
 
 from cytoflow.operations import IOperation
 from cytoflow.views import IView
-from cytoflow.utility import CytoflowOpError, CytoflowViewError
+from cytoflow.utility import CytoflowOpError, CytoflowViewError, parse_fcs
 
 @provides(IOperation)
 class ColorTranslationOp(HasStrictTraits):
@@ -266,12 +266,10 @@ class ColorTranslationOp(HasStrictTraits):
         
         for tube_file in self.controls.values():  
             try:
-                _ = fcsparser.parse(tube_file, 
-                                    meta_data_only = True, 
-                                    reformat_meta = True)
+                _ = parse_fcs(tube_file, meta_data_only = True)
             except Exception as e:
                 raise CytoflowOpError("FCS reader threw an error on tube {0}: {1}"\
-                                   .format(tube_file, e.value))
+                                   .format(tube_file, e))
 
         return ColorTranslationDiagnostic(op = self)
     
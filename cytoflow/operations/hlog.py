@@ -1,6 +1,6 @@
 from traits.api import HasStrictTraits, Str, List, Float, Dict, provides, Constant
 from cytoflow.operations import IOperation
-from cytoflow.utility import CytoflowOpError
+from cytoflow.utility import CytoflowOpError, Transform, memoize
 
 @provides(IOperation)
 class HlogTransformOp(HasStrictTraits):
@@ -75,14 +75,10 @@ class HlogTransformOp(HasStrictTraits):
         if not set(self.b.keys()) <= set(self.channels):
             raise CytoflowOpError("Some keys in op.b are not in experiment")
         
-<<<<<<< HEAD
-        transform = Transformation("hlog", name = self.name)
-=======
         if not set(self.r.keys()) <= set(self.channels):
             raise CytoflowOpError("Some keys in op.r are not in experiment")
         
         new_experiment = experiment.clone()
->>>>>>> refs/remotes/bpteague/master
         
         for channel in self.channels:
             # TODO - probably should change this if the channel range changes
@@ -90,25 +86,46 @@ class HlogTransformOp(HasStrictTraits):
             r = self.r[channel] if channel in self.r else 10**4
             d = np.log10(experiment.metadata[channel]['range'])
             
-            hlog_fwd = \
-                lambda x, b = b, r = r, d = d: hlog(x, b = b, r = r, d = d)
-            hlog_rev = \
-                lambda y, b = b, r = r, d = d: hlog_inv(y, b = b, r = r, d = d)
+            # the transform is deferred, so check its domain here: otherwise
+            # the error would come from whatever reads the events next
+            lo, hi = experiment.pending_extent(channel)
+            x_table, _ = _hlog_table(b, r, d)
+            if lo < x_table[0] or hi > x_table[-1]:
+                raise CytoflowOpError("Channel {0} has values outside the "
+                                      "domain of the hlog transform"
+                                      .format(channel))
+            
+            xform = HlogTransform(b = b, r = r, d = d)
                                
-            new_experiment[channel] = hlog_fwd(experiment[channel])
+            new_experiment.transform_channel(channel, xform)
             
             # TODO - figure out what 
-            new_experiment.metadata[channel]["xforms"].append(hlog_fwd)
-            new_experiment.metadata[channel]["xforms_inv"].append(hlog_rev)
+            new_experiment.metadata[channel]["xforms"].append(xform)
+            new_experiment.metadata[channel]["xforms_inv"].append(xform.inverted)
 
         return new_experiment
     
+class HlogTransform(Transform):
+    """The hyperlog transform with parameters b, r and d, as a Transform"""
+    
+    tname = "hlog"
+    
+    def __init__(self, b, r, d):
+        self.b = b
+        self.r = r
+        self.d = d
+        
+    def forward(self, x):
+        return hlog(x, b = self.b, r = self.r, d = self.d)
+    
+    def inverse(self, y):
+        return hlog_inv(y, b = self.b, r = self.r, d = self.d)
+    
 # the following functions were taken from Eugene Yurtsev's FlowCytometryTools
 # http://gorelab.bitbucket.org/flowcytometrytools/
 # thanks, Eugene!
 
 import numpy as np
-import scipy.optimize
 
 _machine_max = 2**18
 _l_mmax = np.log10(_machine_max)
@@ -126,18 +143,34 @@ def hlog_inv(y, b=500, r=_display_max, d=_l_mmax):
         s = 1
     return s*10**(s*aux) + b*aux - s
 
-def _make_hlog_numeric(b, r, d):
+_HLOG_TABLE_SIZE = 4097
+_HLOG_MAX_ITERATIONS = 20
+
+@memoize(maxsize = 64)
+def _hlog_table(b, r, d):
+    '''
+    Return (x, y), where x = hlog_inv(y) at evenly spaced points y over 
+    hlog()'s domain, [-2r, 2r].  hlog_inv is monotone, so interpolating y 
+    at a new x inverts it.  The tables are cached for each (b, r, d).
+    '''
+    y = np.linspace(-2*r, 2*r, _HLOG_TABLE_SIZE)
+    return (hlog_inv(y, b, r, d), y)
+
+def _hlog_inv_slope(y, b, r, d):
     '''
-    Return a function that numerically computes the hlog transformation for given parameter values.
+    The derivative of hlog_inv with respect to y.
     '''
-    hlog_obj = lambda y, x, b, r, d: hlog_inv(y, b, r, d) - x
-    find_inv = np.vectorize(lambda x: scipy.optimize.brentq(hlog_obj, -2*r, 2*r, 
-                                        args=(x, b, r, d)))
-    return find_inv 
+    aux = 1.*d/r *y
+    s = np.where(y < 0, -1, 1)
+    return 1.*d/r * (np.log(10) * 10**(s*aux) + b)
 
-def hlog(x, b=500, r=_display_max, d=_l_mmax):
+def hlog(x, b=500, r=_display_max, d=_l_mmax, tolerance=1e-12):
     '''
     Base 10 hyperlog transform.
+    
+    Inverts `hlog_inv` by interpolating in a table of its values (built once
+    for each set of parameters), then refines the result with Newton's 
+    method.
 
     Parameters
     ----------
@@ -151,19 +184,41 @@ def hlog(x, b=500, r=_display_max, d=_l_mmax):
     d : num (default = log10(2**18))
         log10 of maximal possible measured value.
         hlog_inv(r) = 10**d
+    tolerance : num | None (default = 1e-12)
+        refine the transformed values until they change by less than
+        `tolerance * r`.  If None, just interpolate (which is good to 
+        about 1e-6 * r.)  Values that don't converge within 
+        _HLOG_MAX_ITERATIONS steps keep the interpolated estimate.
      
     Returns
     -------
     Array of transformed values.
     '''
-    hlog_fun = _make_hlog_numeric(b, r, d)
-    if not hasattr(x, '__len__'): #if transforming a single number
-        y = hlog_fun(x)
-    else:
-        n = len(x)
-        if not n: #if transforming empty container
-            return x
+    if hasattr(x, '__len__') and not len(x): #if transforming empty container
+        return x
+    
+    x_table, y_table = _hlog_table(b, r, d)
+    
+    x = np.asarray(x, dtype = np.float64)
+    
+    with np.errstate(invalid = 'ignore'):
+        if np.any((x < x_table[0]) | (x > x_table[-1])):
+            raise ValueError("Values outside the domain of the hlog transform")
+        
+    y = np.interp(x, x_table, y_table)
+    
+    if tolerance is not None:
+        estimate = y
+        for _ in range(_HLOG_MAX_ITERATIONS):
+            delta = (hlog_inv(y, b, r, d) - x) / _hlog_inv_slope(y, b, r, d)
+            y = y - delta
+            with np.errstate(invalid = 'ignore'):
+                unconverged = ~(np.abs(delta) < tolerance * r) & ~np.isnan(x)
+            if not np.any(unconverged):
+                break
         else:
-            y = hlog_fun(x)
+            # Newton's method didn't settle down for these; the table's 
+            # estimate is better than wherever it wandered off to.
+            y = np.where(unconverged, estimate, y)
+                
     return y
-
@@ -4,14 +4,19 @@ Created on Mar 20, 2015
 @author: brian
 '''
 from traits.api import HasStrictTraits, provides, Str, List, Bool, Int, Any, \
-                       Dict, File, Constant
+                       Dict, File, Constant, Enum, Either, Instance
+
+import multiprocessing
+import multiprocessing.pool
 
 import fcsparser
 import numpy as np
 
 from cytoflow import Experiment
 from cytoflow.operations import IOperation
-from cytoflow.utility import CytoflowOpError
+from cytoflow.utility import CytoflowOpError, PositiveInt, parse_fcs, \
+                             CytoflowFCSError, ColumnStore
+from cytoflow.utility import fcs_reader
 
 class Tube(HasStrictTraits):
     """
@@ -109,6 +114,11 @@ class ImportOp(HasStrictTraits):
         If `coarse == True`, how many random events to choose from each FCS 
         file.
         
+    coarse_seed : Int (default = None)
+        If set, seeds the random choice of events, so a coarse import 
+        chooses the same events every time.  (Each tube still gets a 
+        different subset.)
+        
     ignore_v : Bool
         **CytoFlow** is designed to operate on an `Experiment` containing tubes
         that were all collected under the instrument settings.  In particular,
@@ -120,6 +130,30 @@ class ImportOp(HasStrictTraits):
         experiments.  If so, set `ignore_v` to `True` to disable the voltage
         sanity check.  **BE WARNED - THIS WILL BREAK REAL EXPERIMENTS.**
         
+    workers : Int (default = 1)
+        How many processes to use to parse the FCS files.  If `workers > 1`,
+        the tubes are parsed in parallel by a pool of worker processes; the
+        parsed tubes are still added to the `Experiment` one at a time, in
+        the same order as `tubes`, as soon as each one is ready.
+        
+    pool : multiprocessing.pool.Pool (default = None)
+        If set, parse the FCS files with this pool of worker processes 
+        (see `worker_pool()`) instead of starting one; `workers` is then
+        ignored.  A long-running, threaded program (ie, the GUI) should 
+        start its pool before it starts any other threads: a process forked
+        while another thread holds a lock inherits the lock, held.
+        
+    dtype : Enum("float64", "float32") (default = "float64")
+        The dtype to store the events as; passed to `Experiment.dtype`.  
+        "float32" halves the memory the `Experiment` needs.
+        
+    storage_dir : Str (default = "")
+        If set, keep the events in memory-mapped files in this directory 
+        instead of in memory (see `cytoflow.utility.ColumnStore`), so the
+        `Experiment` can be bigger than RAM.  The FCS files are then read 
+        in this process, whatever `workers` and `pool` are: worker 
+        processes would have to send the events back through memory.
+        
     Examples
     --------
     >>> tube1 = flow.Tube(file = 'RFP_Well_A3.fcs', conditions = {"Dox" : 10.0})
@@ -135,6 +169,7 @@ class ImportOp(HasStrictTraits):
 
     coarse = Bool(False)
     coarse_events = Int(1000)
+    coarse_seed = Either(None, Int)
 
     # experimental conditions: name --> dtype.  can also be "log"
     conditions = Dict(Str, Str)
@@ -142,6 +177,18 @@ class ImportOp(HasStrictTraits):
         
     # DON'T DO THIS
     ignore_v = Bool(False)
+    
+    # how many processes to parse the FCS files with
+    workers = PositiveInt(1)
+    
+    # ... or a pool of them that's already running
+    pool = Instance(multiprocessing.pool.Pool, transient = True)
+    
+    # what to store the events as
+    dtype = Enum("float64", "float32")
+    
+    # where to store the events, if not in memory
+    storage_dir = Str
       
     def apply(self, experiment = None):
         
@@ -164,8 +211,16 @@ class ImportOp(HasStrictTraits):
                     raise CytoflowOpError("The same conditions specified for "
                                           "tube {0} and tube {1}"
                                           .format(i.file, j.file))
+                    
+        # read just the HEADER and TEXT segments of every tube before we 
+        # parse any events, so a bad plate fails right away.
+        self._check_tubes()
         
-        experiment = Experiment()
+        if self.storage_dir:
+            experiment = Experiment(dtype = self.dtype,
+                                    storage = ColumnStore(self.storage_dir))
+        else:
+            experiment = Experiment(dtype = self.dtype)
             
         for condition, dtype in self.conditions.items():
             is_log = False
@@ -176,14 +231,139 @@ class ImportOp(HasStrictTraits):
             if is_log:
                 experiment.metadata[condition]["repr"] = "log"
         
-        for tube in self.tubes:
-            tube_fc = fcsparser.parse(tube.file, reformat_meta = True)
-            if self.coarse:
-                tube_meta, tube_data = tube_fc
-                tube_data = tube_data.loc[np.random.choice(tube_data.index,
-                                                           self.coarse_events,
-                                                           replace = False)]
-                tube_fc = (tube_meta, tube_data)
-            experiment.add_tube(tube_fc, tube.conditions, ignore_v = self.ignore_v)
+        coarse_events = self.coarse_events if self.coarse else 0
+        jobs = [(tube.file, 
+                 coarse_events, 
+                 None if self.coarse_seed is None else self.coarse_seed + idx)
+                for idx, tube in enumerate(self.tubes)]
+        
+        if len(self.tubes) > 1 and not self.storage_dir and \
+           (self.pool is not None or self.workers > 1):
+            own_pool = self.pool is None
+            if own_pool:
+                pool = worker_pool(min(self.workers, len(self.tubes)))
+            else:
+                pool = self.pool
+                
+            try:
+                # imap() hands the results back in the same order as the 
+                # jobs, as soon as each one is ready; so we can add each 
+                # tube while the rest are still being parsed.
+                for idx, tube_fc in enumerate(pool.imap(_parse_tube, jobs)):
+                    experiment.add_tube(tube_fc, 
+                                        self.tubes[idx].conditions, 
+                                        ignore_v = self.ignore_v)
+                if own_pool:
+                    pool.close()
+            except:
+                # (someone else's pool just finishes parsing the tubes we 
+                # didn't add)
+                if own_pool:
+                    pool.terminate()
+                raise
+            finally:
+                if own_pool:
+                    pool.join()
+        else:
+            for idx, job in enumerate(jobs):
+                experiment.add_tube(_parse_tube(job), 
+                                    self.tubes[idx].conditions, 
+                                    ignore_v = self.ignore_v)
             
         return experiment
+    
+    def _check_tubes(self):
+        """
+        Make sure every tube has the same channels, voltages and ranges.
+        
+        `parse_fcs` caches the metadata, so the TEXT segments aren't parsed 
+        again when the events are read in `apply()`.
+        """
+        
+        tube0_file = None
+        tube0_channels = None
+        
+        for tube in self.tubes:
+            try:
+                tube_meta = _parse_meta(tube.file)
+            except Exception as e:
+                raise CytoflowOpError("FCS reader threw an error on tube {0}: {1}"
+                                      .format(tube.file, e))
+            
+            tube_channels = tube_meta["_channels_"].set_index("$PnN")
+            
+            if tube0_channels is None:
+                tube0_file = tube.file
+                tube0_channels = tube_channels
+                continue
+            
+            if set(tube_channels.index) != set(tube0_channels.index):
+                raise CytoflowOpError("Tube {0} doesn't have the same channels "
+                                      "as tube {1}".format(tube.file, tube0_file))
+                
+            for channel in tube0_channels.index:
+                if not self.ignore_v and "$PnV" in tube0_channels.columns \
+                   and tube0_channels.ix[channel]["$PnV"]:
+                    if "$PnV" not in tube_channels.columns:
+                        raise CytoflowOpError("Didn't find a voltage for channel {0} "
+                                              "in tube {1}".format(channel, tube.file))
+                    if tube_channels.ix[channel]["$PnV"] != \
+                       tube0_channels.ix[channel]["$PnV"]:
+                        raise CytoflowOpError("Tube {0} doesn't have the same voltage "
+                                              "for channel {1} as tube {2}"
+                                              .format(tube.file, channel, tube0_file))
+                
+                if tube_channels.ix[channel]["$PnR"] != \
+                   tube0_channels.ix[channel]["$PnR"]:
+                    raise CytoflowOpError("Tube {0} doesn't have the same range "
+                                          "for channel {1} as tube {2}"
+                                          .format(tube.file, channel, tube0_file))
+
+def worker_pool(processes = None):
+    """
+    Start a pool of `processes` worker processes (default: one per CPU) to
+    parse FCS files with, for `ImportOp.pool`.
+    """
+    return multiprocessing.Pool(processes = processes, 
+                                initializer = _init_worker)
+
+# module-level functions so they can be pickled and sent to the worker
+# processes.
+
+def _init_worker():
+    # forked workers inherit the parent's random state; re-seed so that 
+    # coarse imports don't choose the same events from every tube.
+    np.random.seed()
+    
+    # they inherit its locks, too, and the parent may be threaded (ie, the 
+    # GUI): don't wait on a lock another thread held when we forked.
+    fcs_reader._reset_meta_cache()
+
+def _parse_meta(filename):
+    """Parse one FCS file's metadata, the same way _parse_tube() would."""
+    
+    try:
+        return parse_fcs(filename, meta_data_only = True)
+    except CytoflowFCSError:
+        return fcsparser.parse(filename, 
+                               meta_data_only = True, 
+                               reformat_meta = True)
+
+def _parse_tube(job):
+    """Parse one FCS file, optionally choosing a random subset of events."""
+    
+    filename, coarse_events, seed = job
+    
+    # our own reader memory-maps the events instead of reading them in; fall 
+    # back to fcsparser for the (rare) files it can't handle.
+    try:
+        tube_meta, tube_data = parse_fcs(filename)
+    except CytoflowFCSError:
+        tube_meta, tube_data = fcsparser.parse(filename, reformat_meta = True)
+    
+    if coarse_events and coarse_events < len(tube_data.index):
+        random = np.random if seed is None else np.random.RandomState(seed)
+        tube_data = tube_data.loc[random.choice(tube_data.index,
+                                                coarse_events,
+                                                replace = False)]
+    return (tube_meta, tube_data)
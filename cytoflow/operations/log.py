@@ -1,9 +1,8 @@
 import numpy as np
-import pandas as pd
 from traits.api import HasStrictTraits, Str, List, Enum, Float, Constant, \
                        provides
 from cytoflow.operations import IOperation
-from cytoflow.utility import CytoflowOpError
+from cytoflow.utility import CytoflowOpError, Transform
 
 @provides(IOperation)
 class LogTransformOp(HasStrictTraits):
@@ -73,28 +72,34 @@ class LogTransformOp(HasStrictTraits):
         
         new_experiment = experiment.clone()
         
-        data = new_experiment.data
-        
         if self.mode == "mask":
-            gt = pd.Series([True] * len(data.index))
-        
             for channel in self.channels:
-                gt = np.logical_and(gt, data[channel] > self.threshold)        
-
-            data = data.loc[gt]
-            data.reset_index(inplace = True, drop = True)
-            
-        new_experiment.data = data
-        
-        log_fwd = lambda x, t = self.threshold: \
-            np.where(x <= t, np.log10(t), np.log10(x))
+                new_experiment.keep_events_above(channel, self.threshold)
         
-        log_rev = lambda x: 10**x
+        xform = LogTransform(threshold = self.threshold)
         
         for channel in self.channels:
-            new_experiment[channel] = log_fwd(new_experiment[channel])
+            new_experiment.transform_channel(channel, xform)
             
-            new_experiment.metadata[channel]["xforms"].append(log_fwd)
-            new_experiment.metadata[channel]["xforms_inv"].append(log_rev)
+            new_experiment.metadata[channel]["xforms"].append(xform)
+            new_experiment.metadata[channel]["xforms_inv"].append(xform.inverted)
 
         return new_experiment
+    
+class LogTransform(Transform):
+    """
+    log10, with values at or below `threshold` clipped to log10(threshold)
+    """
+    
+    tname = "tlog"
+    
+    def __init__(self, threshold):
+        self.threshold = threshold
+        
+    def forward(self, x):
+        t = self.threshold
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.where(x <= t, np.log10(t), np.log10(x))
+        
+    def inverse(self, y):
+        return 10**y
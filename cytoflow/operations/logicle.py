@@ -2,8 +2,9 @@ from traits.api import HasStrictTraits, provides, Str, List, Float, Dict, \
                         Constant
 import math
 import numpy as np
+import pandas as pd
 
-from cytoflow.utility import CytoflowOpError
+from cytoflow.utility import CytoflowOpError, Transform, memoize
 from logicle_ext.Logicle import Logicle
 from cytoflow.operations import IOperation
 
@@ -134,15 +135,12 @@ class LogicleTransformOp(HasStrictTraits):
         if self.M <= 0:
             raise CytoflowOpError("M must be > 0")
 
+        # the channels are always stored as Experiment.dtype, which is 
+        # floating-point, and logicle_scale() does its math in float64.  (don't
+        # check the channels' dtype here: reading them would apply any 
+        # transforms still pending from the previous operations.)
+        
         for channel in self.channels:
-            # the Logicle C++/SWIG extension is REALLY picky about it
-            # being a double
-            
-            if experiment[channel].dtype != np.float64:
-                raise CytoflowOpError("The dtype for channel {0} MUST be "
-                                      "np.float64.  Please submit a bug report."
-                                      .format(channel))
-            
             if not channel in self.W: 
                 raise CytoflowOpError("W wasn't set for channel {0}"
                                       .format(channel))
@@ -163,16 +161,212 @@ class LogicleTransformOp(HasStrictTraits):
         
         for channel in self.channels:
             
-            el = Logicle(new_experiment.metadata[channel]['range'], 
-                         self.W[channel], 
-                         self.M,
-                         self.A[channel])
+            xform = LogicleTransform(new_experiment.metadata[channel]['range'], 
+                                     self.W[channel], 
+                                     self.M,
+                                     self.A[channel])
             
-            logicle_fwd = lambda x: x.apply(el.scale)
-            logicle_rev = lambda x: x.apply(el.inverse)
+            # the transform is deferred, so make sure it converges here 
+            # (it's hardest at the extremes): otherwise the error would come
+            # from whatever reads the events next
+            xform.forward(np.array(experiment.pending_extent(channel)))
             
-            new_experiment[channel] = logicle_fwd(new_experiment[channel])
-            new_experiment.metadata[channel]["xforms"].append(logicle_fwd)
-            new_experiment.metadata[channel]["xforms_inv"].append(logicle_rev)
+            new_experiment.transform_channel(channel, xform)
+            new_experiment.metadata[channel]["xforms"].append(xform)
+            new_experiment.metadata[channel]["xforms_inv"].append(xform.inverted)
             
         return new_experiment
+
+class LogicleTransform(Transform):
+    """
+    The Logicle transform with parameters T, W, M and A, as a (picklable) 
+    Transform.  The Logicle object itself comes from `get_logicle()`.
+    """
+    
+    tname = "logicle"
+    
+    def __init__(self, T, W, M, A):
+        self.T = T
+        self.W = W
+        self.M = M
+        self.A = A
+        
+    def forward(self, x):
+        return logicle_scale(get_logicle(self.T, self.W, self.M, self.A), x)
+    
+    def inverse(self, y):
+        return logicle_inverse(get_logicle(self.T, self.W, self.M, self.A), y)
+
+# the SWIG extension only transforms one value at a time, and calling it
+# once per event is slow.  these are NumPy ports of Logicle::scale() and
+# Logicle::inverse() from logicle_ext/Logicle.cpp that transform a whole
+# array at once, using the parameters the extension computed.
+
+_TAYLOR_LENGTH = 16
+_EPSILON = np.finfo(np.float64).eps
+
+@memoize(maxsize = 64)
+def get_logicle(T, W, M, A):
+    """
+    Get a Logicle object for these parameters.  The constructor solves for
+    the transform's internal coefficients, so the objects are cached (and
+    shared): don't modify them.
+    """
+    return Logicle(T, W, M, A)
+
+def _logicle_params(el):
+    """
+    Get the "actual" parameters from a Logicle object, and the coefficients
+    of the Taylor series around data zero (x1).
+    """
+    return _logicle_coefficients(el.T(), el.W(), el.M(), el.A())
+
+@memoize(maxsize = 64)
+def _logicle_coefficients(T, W, M, A):
+    """
+    Recompute the coefficients of the Taylor series the same way 
+    Logicle::initialize() does.  Cached, because logicle_scale() and 
+    logicle_inverse() need them on every call.
+    """
+    
+    el = get_logicle(T, W, M, A)
+    
+    p = {"a" : el.a(),
+         "b" : el.b(),
+         "c" : el.c(),
+         "d" : el.d(),
+         "f" : el.f(),
+         "x1" : el.x1()}
+    
+    p["xTaylor"] = p["x1"] + el.w() / 4
+    
+    pos_coef = p["a"] * math.exp(p["b"] * p["x1"])
+    neg_coef = -p["c"] / math.exp(p["d"] * p["x1"])
+    taylor = []
+    for i in range(_TAYLOR_LENGTH):
+        pos_coef *= p["b"] / (i + 1)
+        neg_coef *= -p["d"] / (i + 1)
+        taylor.append(pos_coef + neg_coef)
+    taylor[1] = 0   # exact result of the Logicle condition
+    p["taylor"] = taylor
+    
+    return p
+
+def _series_biexponential(p, scale):
+    """The Taylor series of the biexponential around x1"""
+    
+    taylor = p["taylor"]
+    x = scale - p["x1"]
+    
+    # taylor[1] is identically zero, so skip it
+    total = taylor[_TAYLOR_LENGTH - 1] * x
+    for i in range(_TAYLOR_LENGTH - 2, 1, -1):
+        total = (total + taylor[i]) * x
+    return (total * x + taylor[0]) * x
+
+def _like(value, result):
+    """Return `result` as the same kind of thing `value` is"""
+    
+    if isinstance(value, pd.Series):
+        return pd.Series(result, index = value.index, name = value.name)
+    elif np.ndim(value) == 0:
+        return float(result)
+    else:
+        return result
+
+def logicle_scale(el, value):
+    """
+    The Logicle transform of `value` (a number, or an array-like of them),
+    with the parameters in the Logicle object `el`.  The same as calling
+    `el.scale()` on each value, but vectorized.
+    
+    NaNs (and infinities) pass through.
+    """
+    
+    p = _logicle_params(el)
+    a, b, c, d, f, x1 = p["a"], p["b"], p["c"], p["d"], p["f"], p["x1"]
+    
+    data = np.array(value, dtype = np.float64, ndmin = 1)
+    
+    # reflect negative values
+    negative = data < 0
+    data = np.abs(data)
+    
+    # handle true zero (and non-finite values) separately
+    x = np.where(data == 0, x1, data)
+    todo = np.flatnonzero(np.isfinite(data) & (data != 0))
+    
+    # initial guess at the solution: linear approximation in the quasi-linear
+    # region, otherwise the ordinary logarithm
+    v = data[todo]
+    x[todo] = np.where(v < f, 
+                       x1 + v / p["taylor"][0],
+                       np.log(v / a) / b)
+    
+    # try for double precision unless in extended range
+    tolerance = np.where(x[todo] > 1, 3 * x[todo] * _EPSILON, 3 * _EPSILON)
+    
+    # Halley's method (with cubic convergence), on the values that haven't
+    # converged yet
+    for _ in range(10):
+        if todo.size == 0:
+            break
+        
+        xt = x[todo]
+        v = data[todo]
+        
+        ae2bx = a * np.exp(b * xt)
+        ce2mdx = c / np.exp(d * xt)
+        
+        # near zero use the Taylor series; otherwise this formulation has 
+        # better roundoff behavior
+        y = np.where(xt < p["xTaylor"], 
+                     _series_biexponential(p, xt) - v,
+                     (ae2bx + f) - (ce2mdx + v))
+        
+        abe2bx = b * ae2bx
+        cde2mdx = d * ce2mdx
+        dy = abe2bx + cde2mdx
+        ddy = b * abe2bx - d * cde2mdx
+        
+        delta = y / (dy * (1 - y * ddy / (2 * dy * dy)))
+        x[todo] = xt - delta
+        
+        done = np.abs(delta) < tolerance
+        todo = todo[~done]
+        tolerance = tolerance[~done]
+    else:
+        if todo.size > 0:
+            raise CytoflowOpError("Logicle scale() didn't converge")
+        
+    x = np.where(negative, 2 * x1 - x, x)
+    
+    return _like(value, x.reshape(np.shape(value)))
+
+def logicle_inverse(el, scale):
+    """
+    The inverse Logicle transform of `scale` (a number, or an array-like of
+    them), with the parameters in the Logicle object `el`.  The same as 
+    calling `el.inverse()` on each value, but vectorized.
+    """
+    
+    p = _logicle_params(el)
+    x1 = p["x1"]
+    
+    data = np.array(scale, dtype = np.float64, ndmin = 1)
+    
+    # reflect negative scale regions
+    negative = data < x1
+    data = np.where(negative, 2 * x1 - data, data)
+    
+    # near x1 (data zero) use the series expansion; otherwise this 
+    # formulation has better roundoff behavior
+    with np.errstate(over = 'ignore'):
+        inverse = np.where(data < p["xTaylor"],
+                           _series_biexponential(p, data),
+                           (p["a"] * np.exp(p["b"] * data) + p["f"]) 
+                            - p["c"] / np.exp(p["d"] * data))
+    
+    inverse = np.where(negative, -inverse, inverse)
+    
+    return _like(scale, inverse.reshape(np.shape(scale)))
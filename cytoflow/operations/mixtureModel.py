@@ -1,4 +1,5 @@
 from numpy import array, concatenate
+import pandas as pd
 from sklearn.mixture import GMM
 from traits.api import CStr, HasTraits, ListStr, Int, provides
 
@@ -111,7 +112,7 @@ class MixtureModelOp(HasTraits):
             tubeData = experiment[experiment.data.Tube == tube]
             if subset:
                 tubeData = tubeData.query(subset)
-            cellData = tubeData[self.channels]
+            cellData = tubeData[self.channels].astype("float64")
             
             # Create mixture model
             gmm = GMM(self.numPopulations)
@@ -165,6 +166,12 @@ class MixtureModelOp(HasTraits):
         
         newExperiment = experiment.clone()
         
+        # Build the new columns, then add them to the experiment: writing
+        # into newExperiment.data in place doesn't stick.
+        gmmColumn = pd.Series(index = newExperiment.data.index)
+        popColumns = [pd.Series(index = newExperiment.data.index) 
+                      for _ in range(self.numPopulations)]
+        
         # Do prediction for each tube
         for i, tube in enumerate(set(newExperiment["Tube"])):
             
@@ -183,9 +190,13 @@ class MixtureModelOp(HasTraits):
                 print "Prediction: ", prediction
             
             # This is needed since the order is not preserved when selecting from the set of tubes
-            newExperiment.data.loc[newExperiment.data.Tube == tube, "GMM"] = classification
+            gmmColumn[tubeData.index] = classification
             for j in range(self.numPopulations):
-                newExperiment.data.loc[newExperiment.data.Tube == tube, "Pop_ " + str(j)] = prediction[:, j]
+                popColumns[j][tubeData.index] = prediction[:, j]
+            
+        newExperiment["GMM"] = gmmColumn
+        for j in range(self.numPopulations):
+            newExperiment["Pop_ " + str(j)] = popColumns[j]
             
         newExperiment.metadata["GMM"] = {}
         return newExperiment
@@ -208,9 +219,9 @@ class MixtureModelOp(HasTraits):
         for channel in self.channels:
             for xform in experiment.metadata[channel]['xforms']:
                 if self.debug:
-                    print "Data transforms: ", [t.tname for t in experiment.metadata[channel]['xforms']]
+                    print "Data transforms: ", [getattr(t, "tname", None) for t in experiment.metadata[channel]['xforms']]
                     print "Set transform: ", self.transform
-                if self.transform == xform.tname:
+                if self.transform == getattr(xform, "tname", None):
                     return
                 
                 
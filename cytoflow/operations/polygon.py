@@ -78,7 +78,7 @@ class PolygonOp(HasStrictTraits):
         if not experiment:
             raise CytoflowOpError("No experiment specified")
         
-        if self.name in experiment.data.columns:
+        if self.name in experiment.columns:
             raise CytoflowOpError("op.name is in the experiment already!")
         
         if not self.xchannel or not self.ychannel:
@@ -104,21 +104,20 @@ class PolygonOp(HasStrictTraits):
                                "before applying it!")
         
         # make sure old_experiment doesn't already have a column named self.name
-        if(self.name in experiment.data.columns):
+        if(self.name in experiment.columns):
             raise CytoflowOpError("Experiment already contains a column {0}"
                                .format(self.name))
             
         # use a matplotlib Path because testing for membership is a fast C fn.
         path = mpl.path.Path(np.array(self.vertices))
-        xy_data = experiment.data.as_matrix(columns = [self.xchannel,
-                                                           self.ychannel])
         
         new_experiment = experiment.clone()
         
-        new_experiment[self.name] = path.contains_points(xy_data)
-            
-        new_experiment.conditions[self.name] = "bool"
-        new_experiment.metadata[self.name] = {}
+        new_experiment.add_gate(self.name, 
+            new_experiment.map_events(
+                lambda x, y: path.contains_points(np.column_stack((x, y))),
+                [self.xchannel, self.ychannel],
+                np.bool_))
             
         return new_experiment
     
@@ -5,6 +5,7 @@ from matplotlib.widgets import SpanSelector, Cursor
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 from matplotlib.lines import Line2D    
+import numpy as np
 
 from cytoflow.views.histogram import HistogramView
 from cytoflow.operations import IOperation
@@ -84,7 +85,7 @@ class RangeOp(HasStrictTraits):
             raise CytoflowOpError("You have to set the gate's name "
                                   "before applying it!")
 
-        if self.name in experiment.data.columns:
+        if self.name in experiment.columns:
             raise CytoflowOpError("Experiment already has a column named {0}"
                                   .format(self.name))
         
@@ -106,11 +107,11 @@ class RangeOp(HasStrictTraits):
                                   .format(experiment[self.channel].max()))
         
         new_experiment = experiment.clone()
-        new_experiment[self.name] = \
-            new_experiment[self.channel].between(self.low, self.high)
-            
-        new_experiment.conditions[self.name] = "bool"
-        new_experiment.metadata[self.name] = {}
+        new_experiment.add_gate(self.name, 
+            new_experiment.map_events(lambda x: (x >= self.low) & 
+                                                (x <= self.high),
+                                      [self.channel],
+                                      np.bool_))
             
         return new_experiment
     
@@ -8,6 +8,7 @@ from cytoflow.views.scatterplot import ScatterplotView
 from matplotlib.widgets import RectangleSelector
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
+import numpy as np
 
 
 @provides(IOperation)
@@ -92,7 +93,7 @@ class Range2DOp(HasStrictTraits):
                                   "before applying it!")
         
         # make sure old_experiment doesn't already have a column named self.name
-        if(self.name in experiment.data.columns):
+        if(self.name in experiment.columns):
             raise CytoflowOpError("Experiment already contains a column {0}"
                                .format(self.name))
         
@@ -120,12 +121,13 @@ class Range2DOp(HasStrictTraits):
                                   .format(experiment[self.ychannel].max()))
         
         new_experiment = experiment.clone()
-        x = new_experiment[self.xchannel].between(self.xlow, self.xhigh)
-        y = new_experiment[self.ychannel].between(self.ylow, self.yhigh)
-        new_experiment[self.name] = x & y
-        
-        new_experiment.conditions[self.name] = "bool"
-        new_experiment.metadata[self.name] = {}
+        new_experiment.add_gate(self.name, 
+            new_experiment.map_events(lambda x, y: (x >= self.xlow) & 
+                                                   (x <= self.xhigh) &
+                                                   (y >= self.ylow) & 
+                                                   (y <= self.yhigh),
+                                      [self.xchannel, self.ychannel],
+                                      np.bool_))
 
         return new_experiment
     
@@ -1,10 +1,10 @@
 from traits.api import HasStrictTraits, CFloat, Str, CStr, Instance, \
     Bool, Float, on_trait_change, provides, DelegatesTo, Any, Constant
-import pandas as pd
 
 from matplotlib.widgets import Cursor
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
+import numpy as np
 
 from cytoflow.operations import IOperation
 from cytoflow.utility import CytoflowOpError, CytoflowViewError
@@ -84,7 +84,7 @@ class ThresholdOp(HasStrictTraits):
                                   "before applying it!")
         
         # make sure old_experiment doesn't already have a column named self.name
-        if(self.name in experiment.data.columns):
+        if(self.name in experiment.columns):
             raise CytoflowOpError("Experiment already contains a column {0}"
                                .format(self.name))
             
@@ -94,11 +94,10 @@ class ThresholdOp(HasStrictTraits):
         
         
         new_experiment = experiment.clone()
-        new_experiment[self.name] = \
-            pd.Series(new_experiment[self.channel] > self.threshold)
-            
-        new_experiment.conditions[self.name] = "bool"
-        new_experiment.metadata[self.name] = {}
+        new_experiment.add_gate(self.name, 
+            new_experiment.map_events(lambda x: x > self.threshold,
+                                      [self.channel],
+                                      np.bool_))
             
         return new_experiment
     
@@ -0,0 +1,93 @@
+import unittest
+
+import numpy as np
+import scipy.interpolate
+
+from cytoflow.operations.bleedthrough_piecewise import \
+    _correct_bleedthrough, _correct_bleedthrough_point, _GridInterpolator
+
+class TestBleedthroughPiecewise(unittest.TestCase):
+    
+    def test_correct_bleedthrough(self):
+        """The batched mesh solver matches scipy.optimize.root"""
+        
+        channels = ["a", "b", "c"]
+        np.random.seed(0)
+        
+        splines = {}
+        for from_channel in channels:
+            splines[from_channel] = {}
+            x = np.sort(np.random.uniform(-100, 1e5, 5000))
+            knots = np.linspace(x[0], x[-1], 7)[1:-1]
+            for to_channel in channels:
+                if to_channel == from_channel:
+                    continue
+                
+                k = np.random.uniform(0.01, 0.2)
+                y = k * x + 0.3 * k * np.maximum(x - 3e4, 0)
+                splines[from_channel][to_channel] = \
+                    scipy.interpolate.LSQUnivariateSpline(x, y, t = knots, k = 1)
+                    
+        axis = np.concatenate((np.linspace(-300, 0, 3), 
+                               np.logspace(0, 5, 7)))
+        mesh = np.array([[a, b, c] for a in axis for b in axis for c in axis])
+        
+        corrected = _correct_bleedthrough(mesh, channels, splines)
+        
+        for i in range(0, len(mesh), 37):
+            expected = _correct_bleedthrough_point(mesh[i], channels, splines)
+            np.testing.assert_allclose(corrected[i], expected, 
+                                       rtol = 1e-6, atol = 1e-6)
+            
+    def test_correct_bleedthrough_singular(self):
+        """Only the points with a singular Jacobian fall back to root()"""
+
+        import cytoflow.operations.bleedthrough_piecewise as bp
+
+        # above 5e4, each channel bleeds one-for-one into the other
+        x = np.linspace(0, 1e5, 1001)
+        y = np.where(x < 5e4, 0.1 * x, 5e3 + (x - 5e4))
+        spline = scipy.interpolate.UnivariateSpline(x, y, k = 1, s = 0)
+        channels = ["a", "b"]
+        splines = {"a" : {"b" : spline}, "b" : {"a" : spline}}
+
+        axis = np.linspace(0, 2e4, 5)
+        mesh = np.array([[a, b] for a in axis for b in axis] + [[9e4, 9e4]])
+
+        fallbacks = []
+        def point(y, channels, splines):
+            fallbacks.append(y)
+            return _correct_bleedthrough_point(y, channels, splines)
+
+        bp._correct_bleedthrough_point = point
+        try:
+            corrected = _correct_bleedthrough(mesh, channels, splines)
+        finally:
+            bp._correct_bleedthrough_point = _correct_bleedthrough_point
+
+        self.assertEqual(len(fallbacks), 1)
+        for i in range(len(mesh) - 1):
+            expected = _correct_bleedthrough_point(mesh[i], channels, splines)
+            np.testing.assert_allclose(corrected[i], expected,
+                                       rtol = 1e-6, atol = 1e-6)
+
+    def test_grid_interpolator(self):
+        """The multi-output interpolator matches RegularGridInterpolator"""
+        
+        np.random.seed(0)
+        axes = [np.sort(np.random.uniform(-300, 1e5, 10)) for _ in range(3)]
+        values = np.random.normal(size = (10, 10, 10, 2))
+        points = np.column_stack([np.random.uniform(axis[0], axis[-1], 1000)
+                                  for axis in axes])
+        
+        result = _GridInterpolator(axes, values)(points)
+        for i in range(2):
+            expected = scipy.interpolate.RegularGridInterpolator(
+                           axes, values[..., i])(points)
+            np.testing.assert_allclose(result[:, i], expected, atol = 1e-12)
+            
+        with self.assertRaises(ValueError):
+            _GridInterpolator(axes, values)([[axes[0][0] - 1, 0, 0]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,8 @@ Created on Feb 10, 2015
 
 import unittest
 
+import numpy as np
+
 import cytoflow as flow
 import fcsparser
 
@@ -28,4 +30,283 @@ class TestExperiment(unittest.TestCase):
         self.ex.add_tube(self.tube1, {"time" : 10.0})
         with self.assertRaises(RuntimeError):
             self.ex.add_tube(self.tube2, {"time" : 10.0})
-        
\ No newline at end of file
+                    
+    def test_finalize(self):
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        self.ex.add_tube(self.tube2, {"time" : 20.0})
+        self.ex.finalize()
+        
+        self.assertEqual(len(self.ex.data), 
+                         len(self.tube1[1]) + len(self.tube2[1]))
+        self.assertEqual(set(self.ex.data["time"]), set([10.0, 20.0]))
+        
+        # adding a tube after the data has been concatenated is fine, too
+        tube3 = (self.tube1[0], self.tube1[1])
+        self.ex.add_tube(tube3, {"time" : 30.0})
+        self.assertEqual(len(self.ex.data), 
+                         2 * len(self.tube1[1]) + len(self.tube2[1]))
+        
+    def test_dtype(self):
+        ex = flow.Experiment(dtype = "float32")
+        ex.add_conditions({"time" : "float"})
+        ex.add_tube(self.tube1, {"time" : 10.0})
+        
+        channel = ex.channels[0]
+        self.assertEqual(ex[channel].dtype, "float32")
+        
+        # channels written by an operation keep the experiment's dtype
+        ex[channel] = ex[channel] * 2.0
+        self.assertEqual(ex[channel].dtype, "float32")
+        ex[channel] = ex[channel].values.astype("float64")
+        self.assertEqual(ex[channel].dtype, "float32")
+        
+    def test_category_conditions(self):
+        ex = flow.Experiment()
+        ex.add_conditions({"strain" : "category", "time" : "float"})
+        ex.add_tube(self.tube1, {"strain" : "BL21", "time" : 10.0})
+        ex.add_tube(self.tube2, {"strain" : "Top10G", "time" : 10.0})
+        ex.finalize()
+        ex.add_tube(self.tube1, {"strain" : "DH5a", "time" : 20.0})
+        
+        self.assertEqual(ex["strain"].dtype.name, "category")
+        self.assertEqual(set(ex["strain"].cat.categories), 
+                         set(["BL21", "Top10G", "DH5a"]))
+        self.assertEqual((ex["strain"] == "DH5a").sum(), len(self.tube1[1]))
+        self.assertEqual(ex["time"].dtype, "float64")
+        
+    def test_clone(self):
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        channel = self.ex.channels[0]
+        old_values = self.ex[channel].copy()
+        
+        ex2 = self.ex.clone()
+        ex2["gate"] = ex2[channel] > 0
+        ex2[channel] = ex2[channel] * 2
+        
+        # the clone's changes don't show up in the original
+        self.assertFalse("gate" in self.ex.data.columns)
+        self.assertTrue((self.ex[channel] == old_values).all())
+        self.assertTrue((ex2[channel] == old_values * 2).all())
+        
+        # ... and the columns the clone didn't change are still shared
+        other = self.ex.channels[1]
+        self.assertTrue(np.may_share_memory(ex2[other].values,
+                                            self.ex[other].values))
+        
+        # ... or the other way around
+        self.ex[channel] = self.ex[channel] + 1
+        self.assertTrue((ex2[channel] == old_values * 2).all())
+        
+    def test_gates(self):
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        channel = self.ex.channels[0]
+        
+        self.ex.add_gate("high", self.ex[channel] > 100)
+        self.ex.add_gate("low", self.ex[channel] < 10)
+        self.assertEqual(self.ex.conditions["high"], "bool")
+        
+        with self.assertRaises(RuntimeError):
+            self.ex.add_gate("high", self.ex[channel] > 100)
+        
+        high = self.ex.get_gate("high")
+        low = self.ex.get_gate("low")
+        self.assertEqual(high.count(), (self.ex[channel] > 100).sum())
+        self.assertEqual((~(high | low)).count(),
+                         len(self.ex.query("not high and not low")))
+        
+        # reading a column, or mapping over one, doesn't unpack the gates
+        ex2 = self.ex.clone()
+        ex2[channel]
+        ex2.map_events(lambda x, h: (x > 1000) & h, [channel, "high"], bool)
+        self.assertIsNone(ex2._gated_data)
+        
+        # ... and neither does a query: but its result has the gates
+        subset = ex2.query("high")
+        self.assertIsNone(ex2._gated_data)
+        self.assertTrue(subset["high"].all())
+        self.assertEqual(subset["low"].sum(), (high & low).count())
+        self.assertEqual(set(ex2.columns), set(ex2.data.columns))
+        
+        # gates are carried through clones and filtered with the events
+        ex2 = self.ex.clone()
+        ex2.data = ex2.data[ex2.data["high"]]
+        self.assertTrue(ex2["high"].all())
+        self.assertEqual(len(ex2.get_gate("low")), high.count())
+        
+    def test_query_cache(self):
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        self.ex.add_tube(self.tube2, {"time" : 20.0})
+        
+        self.assertEqual(len(self.ex.query("time == 10.0")), len(self.tube1[1]))
+        self.assertEqual(len(self.ex.query("time == 10.0")), len(self.tube1[1]))
+        
+        # changing the data invalidates the cached masks
+        self.ex["time"] = 10.0
+        self.assertEqual(len(self.ex.query("time == 10.0")), len(self.ex.data))
+        
+    def test_transform_channel(self):
+        from cytoflow.utility import LinearTransform, PowerTransform
+        
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        channel = self.ex.channels[0]
+        raw = self.ex[channel].values.copy()
+        
+        # filters and transforms are deferred, and applied together
+        ex2 = self.ex.clone()
+        ex2.transform_channel(channel, LinearTransform(offset = -100))
+        ex2.keep_events_above(channel, 0)
+        ex2.transform_channel(channel, PowerTransform(a = 2))
+        
+        expected = (raw[raw > 100] - 100) ** 2
+        self.assertEqual(len(ex2.data), len(expected))
+        self.assertTrue((abs(ex2[channel].values - expected) <= 
+                         1e-6 * expected).all())
+        
+        # ... without touching the original
+        self.assertTrue((self.ex[channel].values == raw).all())
+
+    def test_pending_extent(self):
+        from cytoflow.utility import LinearTransform, CytoflowOpError
+
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        channel = self.ex.channels[0]
+        raw = self.ex[channel].values.copy()
+
+        ex2 = self.ex.clone()
+        ex2.chunk_size = 999
+        ex2.keep_events_above(channel, 100)
+        ex2.transform_channel(channel, LinearTransform(scale = -1))
+
+        # the extent comes from the pending work, which is still pending
+        self.assertEqual(ex2.pending_extent(channel),
+                         (-raw[raw > 100].max(), -raw[raw > 100].min()))
+        self.assertTrue(ex2._pending_xforms)
+
+        # so an operation can raise the error itself
+        ex2.transform_channel(channel, LinearTransform(scale = 10**12))
+        with self.assertRaises(CytoflowOpError):
+            flow.HlogTransformOp(channels = [channel]).apply(ex2)
+
+    def test_subsample(self):
+        from cytoflow.utility import LinearTransform
+
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        channel = self.ex.channels[0]
+        self.ex.add_gate("high", self.ex[channel] > 100)
+        self.ex.transform_channel(channel, LinearTransform(scale = 2))
+
+        # the same seed picks the same events
+        ex2 = self.ex.subsample(100, seed = 1)
+        ex3 = self.ex.subsample(100, seed = 1)
+        self.assertEqual(len(ex2.data), 100)
+        self.assertTrue((ex2[channel].values == ex3[channel].values).all())
+
+        # ... and the gates and pending transforms come along
+        self.assertTrue((ex2["high"] == (ex2[channel] > 200)).all())
+
+        ex4 = self.ex.subsample(len(self.ex.data) + 1)
+        self.assertEqual(len(ex4.data), len(self.ex.data))
+
+    def test_chunk_size(self):
+        from cytoflow.utility import LinearTransform
+        
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        channel = self.ex.channels[0]
+        
+        ex2 = self.ex.clone()
+        ex2.chunk_size = 999
+        ex2.transform_channel(channel, LinearTransform(offset = -100))
+        ex2.keep_events_above(channel, 0)
+        
+        data = self.ex.data
+        expected = data[channel][data[channel] > 100].values - 100
+        self.assertTrue((ex2[channel].values == expected).all())
+        
+        mask = ex2.map_events(lambda x: x > 500, [channel], bool)
+        self.assertTrue((mask == (expected > 500)).all())
+        
+    def test_storage(self):
+        from cytoflow.utility import ColumnStore, LinearTransform
+        
+        storage = ColumnStore()
+        self.addCleanup(storage.close)
+        
+        ex2 = flow.Experiment(storage = storage)
+        ex2.add_conditions({"time" : "float"})
+        for ex in (self.ex, ex2):
+            ex.add_tube(self.tube1, {"time" : 10.0})
+            ex.add_tube(self.tube2, {"time" : 20.0})
+            
+        channel = self.ex.channels[0]
+        self.assertEqual(ex2.data.shape, self.ex.data.shape)
+        for column in self.ex.data.columns:
+            self.assertTrue((ex2[column] == self.ex[column]).all())
+            
+        # transforms and filters write new columns to disk, not over the
+        # (shared) originals
+        ex3 = ex2.clone()
+        ex3.transform_channel(channel, LinearTransform(offset = -100))
+        ex3.keep_events_above(channel, 0)
+        ex3.data
+        
+        data = self.ex.data
+        expected = data[channel][data[channel] > 100].values - 100
+        self.assertTrue((ex3[channel].values == expected).all())
+        self.assertTrue((ex2[channel] == self.ex[channel]).all())
+        
+        # ... and so do operations
+        ex3["half"] = ex3[channel] / 2
+        ex3.data.sum()
+        self.assertIsInstance(ex3["half"].values, np.memmap)
+        self.assertIsInstance(ex3[channel].values, np.memmap)
+        
+    def test_save_load(self):
+        import shutil
+        import tempfile
+        
+        self.ex.add_tube(self.tube1, {"time" : 10.0})
+        self.ex.add_tube(self.tube2, {"time" : 20.0})
+        channel = self.ex.channels[0]
+        self.ex.add_gate("high", self.ex[channel] > 100)
+        
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        
+        self.ex.save(path)
+        ex2 = flow.Experiment.load(path)
+        
+        self.assertEqual(ex2.channels, self.ex.channels)
+        self.assertEqual(ex2.conditions, self.ex.conditions)
+        self.assertEqual(ex2.metadata[channel]["range"], 
+                         self.ex.metadata[channel]["range"])
+        self.assertEqual(ex2.get_gate("high"), self.ex.get_gate("high"))
+        for column in self.ex.data.columns:
+            self.assertTrue((ex2[column] == self.ex[column]).all())
+            
+        # the loaded events are read-only; changing them copies them
+        ex2[channel] = ex2[channel] * 2
+        self.assertTrue((ex2[channel] == self.ex[channel] * 2).all())
+            
+    def test_save_load_categories(self):
+        import shutil
+        import tempfile
+        
+        # numpy-typed condition values, as from a pandas DataFrame
+        ex = flow.Experiment()
+        ex.add_conditions({"dox" : "category", "strain" : "category"})
+        ex.add_tube(self.tube1, {"dox" : np.int64(1), 
+                                 "strain" : np.str_("BL21")})
+        ex.add_tube(self.tube2, {"dox" : np.int64(10), 
+                                 "strain" : np.str_("Top10G")})
+        
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        
+        ex.save(path)
+        ex2 = flow.Experiment.load(path)
+        
+        self.assertIsInstance(ex2.channels[0], str)
+        for condition in ("dox", "strain"):
+            self.assertEqual(list(ex2[condition].cat.categories),
+                             list(ex[condition].cat.categories))
+            self.assertTrue((ex2[condition] == ex[condition]).all())
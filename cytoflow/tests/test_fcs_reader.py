@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+import fcsparser
+
+from cytoflow.utility import parse_fcs
+
+class TestFCSReader(unittest.TestCase):
+    """
+    Check our memory-mapped FCS reader against fcsparser
+    """
+    
+    def setUp(self):
+        import os
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        self.file = cwd + '/data/Plate01/RFP_Well_A3.fcs'
+        
+    def test_data(self):
+        meta, data = parse_fcs(self.file)
+        fp_meta, fp_data = fcsparser.parse(self.file, reformat_meta = True)
+        
+        self.assertEqual(list(data.columns), list(fp_data.columns))
+        self.assertEqual(meta["_channel_names_"], fp_meta["_channel_names_"])
+        self.assertTrue(np.array_equal(data.values, fp_data.values))
+        
+    def test_metadata(self):
+        meta = parse_fcs(self.file, meta_data_only = True)
+        fp_meta = fcsparser.parse(self.file, 
+                                  meta_data_only = True, 
+                                  reformat_meta = True)
+        
+        channels = meta["_channels_"].set_index("$PnN")
+        fp_channels = fp_meta["_channels_"].set_index("$PnN")
+        
+        for channel in channels.index:
+            self.assertEqual(channels.ix[channel]["$PnR"], 
+                             fp_channels.ix[channel]["$PnR"])
+        
+        self.assertEqual(meta["$TOT"], fp_meta["$TOT"])
+        self.assertEqual(meta["$FIL"], fp_meta["$FIL"])
+        
+    def test_metadata_cache(self):
+        meta = parse_fcs(self.file, meta_data_only = True)
+        meta["$FIL"] = "foo"
+        meta["_channels_"]["$PnR"] = "0"
+        
+        # modifying what we got back doesn't change the cached copy
+        meta2, _ = parse_fcs(self.file)
+        self.assertNotEqual(meta2["$FIL"], "foo")
+        self.assertTrue((meta2["_channels_"]["$PnR"] != "0").all())
+    
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+import scipy.optimize
+
+from cytoflow.operations.hlog import hlog, hlog_inv
+
+class TestHlog(unittest.TestCase):
+    
+    def test_hlog(self):
+        """
+        Compare the table-based transform to solving for each value
+        """
+        
+        b, r, d = 500, 10**4, np.log10(2**18)
+        x = np.linspace(-1000, 2**18, 500)
+        
+        y = hlog(x, b = b, r = r, d = d)
+        for xx, yy in zip(x, y):
+            y_ref = scipy.optimize.brentq(lambda y: hlog_inv(y, b, r, d) - xx,
+                                          -2 * r, 2 * r)
+            self.assertAlmostEqual(yy, y_ref, places = 6)
+            
+        self.assertTrue(np.allclose(hlog_inv(y, b, r, d), x))
+        
+    def test_hlog_unconverged(self):
+        """
+        Values that Newton's method can't refine keep the table's estimate
+        """
+        
+        x = np.linspace(-1000, 2**18, 500)
+        
+        # nothing changes by less than 0, so nothing converges
+        y = hlog(x, tolerance = 0)
+        self.assertTrue((y == hlog(x, tolerance = None)).all())
+        self.assertTrue(np.allclose(y, hlog(x), atol = 1e-5 * 10**4))
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,10 @@
 import unittest
+import pickle
 
 import fcsparser
 import cytoflow as flow
+from cytoflow.operations.logicle import logicle_scale, logicle_inverse
+from cytoflow.operations.logicle_ext.Logicle import Logicle
 
 class TestLogicle(unittest.TestCase):
     
@@ -46,4 +49,38 @@ class TestLogicle(unittest.TestCase):
         el.estimate(self.ex)
         ex2 = el.apply(self.ex)
         
+    def test_logicle_pickle(self):
+        """
+        The transformed experiment (and its xforms) can be pickled
+        """
+        
+        el = flow.LogicleTransformOp()
+        el.name = "Logicle"
+        el.channels = ['Y2-A']
+        
+        el.estimate(self.ex)
+        ex2 = el.apply(self.ex)
+        
+        ex3 = pickle.loads(pickle.dumps(ex2, pickle.HIGHEST_PROTOCOL))
+        xform = ex3.metadata['Y2-A']['xforms'][0]
+        self.assertEqual(xform, ex2.metadata['Y2-A']['xforms'][0])
+        self.assertAlmostEqual(ex3.metadata['Y2-A']['xforms_inv'][0](xform(100.0)),
+                               100.0)
+        
+    def test_logicle_vectorized(self):
+        """
+        Make sure the NumPy transform matches the C++ one
+        """
+        
+        el = Logicle(self.ex.metadata['Y2-A']['range'], 0.5, 4.5, 0.0)
+        data = self.ex['Y2-A'].values[0:1000]
+        
+        scaled = logicle_scale(el, data)
+        for x, y in zip(data, scaled):
+            self.assertAlmostEqual(el.scale(x), y, places = 12)
+            
+        inverted = logicle_inverse(el, scaled)
+        for x, y in zip(scaled, inverted):
+            self.assertAlmostEqual(el.inverse(x), y, places = 6)
+        
     ### TODO - test the apply function error checking
\ No newline at end of file
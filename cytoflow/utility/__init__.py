@@ -1,4 +1,10 @@
 from util import cartesian, iqr, geom_mean, num_hist_bins
 from util import CytoflowError, CytoflowOpError, CytoflowViewError
 
-from custom_traits import PositiveInt, PositiveFloat
\ No newline at end of file
+from custom_traits import PositiveInt, PositiveFloat
+from fcs_reader import parse_fcs, CytoflowFCSError, CytoflowFCSNotSupported
+from bitset import BitSet
+from cache import LRUCache, memoize
+from transform import Transform, InverseTransform, ComposedTransform, LinearTransform, PowerTransform
+from column_store import ColumnStore
+from cancel import CytoflowCancelled, cancellable, check_cancelled
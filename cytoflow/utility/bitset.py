@@ -0,0 +1,136 @@
+from __future__ import division
+
+import numpy as np
+
+from util import CytoflowError
+
+# the number of bits set in each possible byte
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype = np.uint8)
+
+class BitSet(object):
+    """
+    A packed array of bools: one bit per event instead of one byte.
+
+    Used by `Experiment` to store gate membership.  BitSets are immutable;
+    the logical operators (`&`, `|`, `^` and `~`) work a byte (eight events)
+    at a time and return new BitSets.
+
+    Parameters
+    ----------
+    mask : array-like of bool
+        The membership of each event.
+
+    Examples
+    --------
+    >>> a = BitSet([True, False, True])
+    >>> b = BitSet([True, True, False])
+    >>> (a & ~b).to_mask()
+    array([False, False,  True], dtype=bool)
+    >>> (a | b).count()
+    3
+    """
+
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype = np.bool_)
+        if mask.ndim != 1:
+            raise CytoflowError("A BitSet must be made from a 1-D mask")
+
+        # packbits leaves the unused bits in the last byte cleared; the
+        # rest of this class counts on it.
+        self._bits = np.packbits(mask)
+        self._len = len(mask)
+
+    @classmethod
+    def _from_bits(cls, bits, length):
+        bitset = cls.__new__(cls)
+        bitset._bits = bits
+        bitset._len = length
+        return bitset
+
+    def to_bytes(self):
+        """The packed bits, as a string of bytes (see `from_bytes()`)"""
+        return self._bits.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, length):
+        """
+        A BitSet of `length` events, from the bytes that `to_bytes()` 
+        returned.
+        """
+        bits = np.frombuffer(data, dtype = np.uint8)
+        if len(bits) != (length + 7) // 8:
+            raise CytoflowError("{0} bytes can't hold a BitSet of length {1}"
+                                .format(len(bits), length))
+        return cls._from_bits(bits, length)
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def nbytes(self):
+        """The memory the packed bits use, in bytes"""
+        return self._bits.nbytes
+
+    def to_mask(self):
+        """Unpack into a bool array with one element per event"""
+        return np.unpackbits(self._bits)[:self._len].view(np.bool_)
+
+    def take(self, indices):
+        """
+        The membership of just the events at `indices`, as a bool array; 
+        without unpacking the rest.
+        """
+        indices = np.asarray(indices, dtype = np.intp)
+        bits = self._bits[indices >> 3] >> (7 - (indices & 7))
+        return (bits & 1).astype(np.bool_)
+
+    def count(self):
+        """The number of events in the set"""
+        return int(_POPCOUNT[self._bits].sum(dtype = np.int64))
+
+    def _check(self, other):
+        if not isinstance(other, BitSet):
+            return NotImplemented
+        if len(other) != self._len:
+            raise CytoflowError("Can't combine BitSets of different lengths "
+                                "({0} and {1})".format(self._len, len(other)))
+
+    def __and__(self, other):
+        if self._check(other) is NotImplemented:
+            return NotImplemented
+        return BitSet._from_bits(self._bits & other._bits, self._len)
+
+    def __or__(self, other):
+        if self._check(other) is NotImplemented:
+            return NotImplemented
+        return BitSet._from_bits(self._bits | other._bits, self._len)
+
+    def __xor__(self, other):
+        if self._check(other) is NotImplemented:
+            return NotImplemented
+        return BitSet._from_bits(self._bits ^ other._bits, self._len)
+
+    def __invert__(self):
+        bits = ~self._bits
+
+        # clear the unused bits in the last byte again
+        tail = self._len % 8
+        if tail:
+            bits[-1] &= (0xFF << (8 - tail)) & 0xFF
+
+        return BitSet._from_bits(bits, self._len)
+
+    def __eq__(self, other):
+        if not isinstance(other, BitSet):
+            return NotImplemented
+        return self._len == other._len and np.array_equal(self._bits,
+                                                          other._bits)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "BitSet({0} of {1} set)".format(self.count(), self._len)
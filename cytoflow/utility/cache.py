@@ -0,0 +1,136 @@
+import functools
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A thread-safe dict that forgets its least-recently-used items once it
+    holds more than `maxsize` of them (or, if `maxbytes` is set, once they
+    add up to more than `maxbytes`.)
+
+    Parameters
+    ----------
+    maxsize : Int (default = 128)
+        The most items to keep.
+
+    maxbytes : Int (default = None)
+        The most memory the items can use, as measured by `sizeof`.  The
+        most recently added item is always kept, even if it's bigger.
+
+    sizeof : callable (default = None)
+        Returns the size of an item, in bytes.  Required if `maxbytes` is
+        set.
+    """
+
+    def __init__(self, maxsize = 128, maxbytes = None, sizeof = None):
+        if maxbytes is not None and sizeof is None:
+            raise ValueError("maxbytes needs a sizeof function")
+
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        """Get the item for `key` (and mark it as recently used)"""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value, size = None):
+        """
+        Add `value` for `key`.  If `size` is given, use it instead of
+        `sizeof(value)`: ie, if the caller knows that some of `value` is
+        shared with other items, and shouldn't be counted twice.
+        """
+        if size is None:
+            size = self.sizeof(value) if self.maxbytes is not None else 0
+
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+            self._items[key] = value
+            self._sizes[key] = size
+            self.nbytes += size
+
+            while len(self._items) > self.maxsize or \
+                  (self.maxbytes is not None and
+                   self.nbytes > self.maxbytes and
+                   len(self._items) > 1):
+                self._remove(next(iter(self._items)))
+
+    def _remove(self, key):
+        del self._items[key]
+        self.nbytes -= self._sizes.pop(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+def memoize(maxsize = 128):
+    """
+    A decorator that caches a function's return values in an `LRUCache`,
+    keyed on its arguments (which must be hashable.)  The cache is shared by
+    the whole process, and is available as the wrapper's `cache` attribute.
+
+    Only use this on functions whose results are never modified by their
+    callers: everyone who calls with the same arguments gets the same
+    object.
+
+    Examples
+    --------
+    >>> @memoize(maxsize = 16)
+    ... def table(b, r, d):
+    ...     return expensive_lookup_table(b, r, d)
+    >>> table.cache.clear()
+    """
+
+    def decorator(fn):
+        cache = LRUCache(maxsize)
+        missing = object()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = args
+            if kwargs:
+                key += (missing,) + tuple(sorted(kwargs.items()))
+
+            value = cache.get(key, missing)
+            if value is missing:
+                # don't hold the lock while we compute; at worst, two
+                # threads both compute the same value.
+                value = fn(*args, **kwargs)
+                cache[key] = value
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
@@ -0,0 +1,52 @@
+import threading
+from contextlib import contextmanager
+
+class CytoflowCancelled(BaseException):
+    """
+    Raised by `check_cancelled()` when the work in progress is no longer
+    wanted.  Not a `CytoflowError`: nothing went wrong.  Like 
+    `KeyboardInterrupt`, it derives from `BaseException`, so the
+    `except Exception` handlers that turn errors into `CytoflowError`s let
+    it through.
+    """
+    pass
+
+_local = threading.local()
+
+@contextmanager
+def cancellable(is_cancelled):
+    """
+    Make the work done (in this thread) inside the `with` block cancellable.
+
+    Long-running loops call `check_cancelled()` between chunks of work; once
+    `is_cancelled()` returns True, the next check raises `CytoflowCancelled`.
+
+    Parameters
+    ----------
+    is_cancelled : callable
+        Takes no arguments; returns True if the work should stop.  It's
+        called often, so it should be cheap.
+
+    Examples
+    --------
+    >>> generation = wi.generation
+    >>> try:
+    ...     with cancellable(lambda: wi.generation != generation):
+    ...         result = op.apply(experiment)
+    ... except CytoflowCancelled:
+    ...     result = None
+    """
+
+    old = getattr(_local, "is_cancelled", None)
+    _local.is_cancelled = is_cancelled
+    try:
+        yield
+    finally:
+        _local.is_cancelled = old
+
+def check_cancelled():
+    """Raise `CytoflowCancelled` if the work in progress has been cancelled"""
+
+    is_cancelled = getattr(_local, "is_cancelled", None)
+    if is_cancelled is not None and is_cancelled():
+        raise CytoflowCancelled()
@@ -0,0 +1,220 @@
+from __future__ import division
+
+import os
+import atexit
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# how many events to copy at a time
+_CHUNK_SIZE = 1 << 20
+
+# the files and directories that couldn't be deleted yet -- ie, on Windows,
+# where a file can't be deleted while it's mapped.  try again at exit.
+_leftovers = set()
+
+def _remove(path):
+    """Delete the file or (empty) directory `path`; return True if it's gone"""
+    try:
+        if os.path.isdir(path):
+            os.rmdir(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+    except OSError:
+        return False
+    return True
+
+@atexit.register
+def _remove_leftovers():
+    # (in reverse order, so the files in a directory go before it)
+    for path in sorted(_leftovers, reverse = True):
+        _remove(path)
+
+class ColumnStore(object):
+    """
+    Keeps an `Experiment`'s events on disk instead of in memory.
+
+    Give an Experiment a ColumnStore (as its `storage`) and the numeric
+    columns of its events -- the channels, and any numeric conditions -- are
+    written to memory-mapped files instead of being allocated in memory.  The
+    columns are stored column-major, one file per dtype, so each column is
+    contiguous on disk; reading a column (or streaming through it in chunks,
+    see `Experiment.chunk_size`) only pages in that column.  The operating
+    system keeps as much of it in memory as will fit, so an Experiment can
+    be larger than RAM.
+
+    Categorical conditions are small (one code per event) and stay in
+    memory.  Numeric columns that operations add or change later are
+    written to new files, too (see `Experiment.__setitem__`), and the
+    Experiment stops pandas from merging columns of the same dtype into one
+    block, which would copy the memory-mapped ones into memory.
+
+    The files are deleted as soon as they are mapped (on platforms that
+    allow it), so they go away with the last reference to the data.  The
+    others, and the temporary directory if the store made one, are deleted
+    by `close()` -- which is called when the store is garbage-collected --
+    or, if they're still in use then, when the program exits.
+
+    Parameters
+    ----------
+    path : Str (default = None)
+        The directory to put the files in.  If None, use a new temporary
+        directory.
+
+    Examples
+    --------
+    >>> ex = flow.ImportOp(tubes = tubes, storage_dir = "/scratch").apply()
+    >>> # or
+    >>> ex = flow.Experiment(storage = ColumnStore("/scratch"))
+    """
+
+    def __init__(self, path = None):
+        # did we make the directory?
+        self._own_path = path is None
+        
+        if path is None:
+            path = tempfile.mkdtemp(prefix = "cytoflow-")
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        
+        # the files we couldn't delete when we mapped them
+        self._files = []
+        
+    def close(self):
+        """
+        Delete the files that are left, and the directory if the store made
+        it.  Whatever is still in use is deleted when the program exits.
+        Don't allocate anything after closing the store.
+        """
+        
+        paths = self._files + ([self.path] if self._own_path else [])
+        self._files = []
+        self._own_path = False
+        
+        for path in paths:
+            if not _remove(path):
+                _leftovers.add(path)
+                
+    def __del__(self):
+        if hasattr(self, "_files"):
+            self.close()
+            
+    def __getstate__(self):
+        # a copy (ie, in another process) doesn't own the files
+        state = self.__dict__.copy()
+        state["_own_path"] = False
+        state["_files"] = []
+        return state
+
+    def allocate(self, shape, dtype):
+        """A new, writable, memory-mapped array"""
+
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype = dtype)
+
+        fd, filename = tempfile.mkstemp(suffix = ".dat", dir = self.path)
+        os.close(fd)
+
+        values = np.memmap(filename, dtype = dtype, mode = 'w+', shape = shape)
+
+        # the mapping keeps the contents around until it's closed.  (on 
+        # Windows, the file can't be deleted until then: close() tries 
+        # again.)
+        if not _remove(filename):
+            self._files.append(filename)
+
+        return values
+
+    def concat(self, frames, dtypes = None):
+        """
+        Concatenate DataFrames with the same columns, like
+        `pd.concat(frames, ignore_index = True)`, but store the numeric
+        columns on disk.
+
+        Parameters
+        ----------
+        frames : list(pandas.DataFrame)
+            The frames to concatenate.
+
+        dtypes : dict(Str : dtype) (default = None)
+            The dtypes to store some columns as; the others keep their
+            (common) dtype.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The numeric columns are grouped by dtype, so they may not be in
+            the same order as in `frames`.
+        """
+        return self._build(frames, None, dtypes or {})
+
+    def take(self, frame, keep = None):
+        """
+        Copy `frame` to disk, keeping only the rows where the bool array
+        `keep` is True (or all of them, if `keep` is None.)  The new frame
+        is indexed from 0.
+        """
+        return self._build([frame], keep, {})
+
+    def _build(self, frames, keep, dtypes):
+        columns = frames[0].columns
+
+        if keep is None:
+            num_events = sum(len(frame.index) for frame in frames)
+        else:
+            num_events = int(np.count_nonzero(keep))
+
+        groups = OrderedDict()
+        in_memory = []
+        for column in columns:
+            if column in dtypes:
+                dtype = np.dtype(dtypes[column])
+            elif all(frame[column].dtype.kind in "biuf" for frame in frames):
+                dtype = np.result_type(*[frame[column].dtype
+                                         for frame in frames])
+            else:
+                in_memory.append(column)
+                continue
+
+            groups.setdefault(dtype, []).append(column)
+
+        parts = []
+        for dtype, group in groups.iteritems():
+            values = self.allocate((len(group), num_events), dtype)
+
+            for idx, column in enumerate(group):
+                pos = 0
+                for frame in frames:
+                    src = frame[column].values
+                    for start in range(0, len(src), _CHUNK_SIZE):
+                        chunk = src[start:start + _CHUNK_SIZE]
+                        if keep is not None:
+                            chunk = chunk[keep[start:start + _CHUNK_SIZE]]
+                        values[idx, pos:pos + len(chunk)] = chunk
+                        pos += len(chunk)
+
+            # a frame made from a 2-D array wraps it without copying
+            parts.append(pd.DataFrame(values.T, columns = group, copy = False))
+
+        if in_memory:
+            if keep is None:
+                other = pd.concat([frame[in_memory] for frame in frames],
+                                  ignore_index = True)
+            else:
+                other = frames[0][in_memory][keep]
+                other.reset_index(drop = True, inplace = True)
+            parts.append(other)
+
+        if not parts:
+            return pd.DataFrame(index = range(num_events))
+        elif len(parts) == 1:
+            return parts[0]
+        else:
+            return pd.concat(parts, axis = 1, copy = False)
+
+    def __repr__(self):
+        return "ColumnStore({0!r})".format(self.path)
@@ -0,0 +1,319 @@
+from __future__ import division
+
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from util import CytoflowError
+
+class CytoflowFCSError(CytoflowError):
+    """Raised when an FCS file can't be read."""
+    pass
+
+class CytoflowFCSNotSupported(CytoflowFCSError):
+    """
+    Raised when an FCS file is valid but uses a feature that `parse_fcs`
+    doesn't implement (ASCII data, mixed-width integers, etc.)  Callers can
+    fall back to `fcsparser.parse()` for these files.
+    """
+    pass
+
+# per-channel keywords, ie $P3N or $P12V
+_CHANNEL_KEYWORD = re.compile(r"^\$P(\d+)([A-Z]+)$")
+
+# FCS $DATATYPE --> numpy kind
+_DATATYPES = {"F" : "f", "D" : "f", "I" : "u"}
+
+# FCS $BYTEORD --> numpy byte order
+_BYTEORDS = {"1,2,3,4" : "<",
+             "1,2" : "<",
+             "4,3,2,1" : ">",
+             "2,1" : ">"}
+
+# parsed headers, keyed on (path, modification time, size) so that a file
+# that changes on disk is re-read.  the headers are small, but keep the
+# cache bounded anyway.
+_meta_cache = OrderedDict()
+_meta_cache_lock = threading.Lock()
+_META_CACHE_SIZE = 1024
+
+def _reset_meta_cache():
+    """
+    Start the header cache over, with a new lock.  A forked process (see 
+    `ImportOp.workers`) inherits the lock in whatever state it was in: if
+    another thread of the parent held it, the child would deadlock.
+    """
+    global _meta_cache, _meta_cache_lock
+    _meta_cache = OrderedDict()
+    _meta_cache_lock = threading.Lock()
+
+def parse_fcs(filename, meta_data_only = False):
+    """
+    Read an FCS file, memory-mapping its DATA segment.
+
+    The return value has the same layout as
+    `fcsparser.parse(filename, reformat_meta = True)`, so it can be passed
+    straight to `Experiment.add_tube()`: the metadata is a dict of the TEXT
+    segment keywords, with the per-channel keywords ($PnN, $PnV, $PnR, etc)
+    collected into a DataFrame under the key `_channels_` and the channel
+    names under `_channel_names_`.
+
+    Unlike `fcsparser`, the events are not read into memory.  The DataFrame
+    is a view on a read-only `numpy.memmap` of the DATA segment, described by
+    the `$BEGINDATA`, `$ENDDATA`, `$DATATYPE` and `$BYTEORD` keywords; the
+    data is only copied if it has to be converted (non-native byte order, or
+    integer data with unused high bits that have to be masked off.)
+
+    Parameters
+    ----------
+    filename : Str
+        The FCS file to read.
+
+    meta_data_only : Bool (default = False)
+        If True, only read the HEADER and TEXT segments, and return only the
+        metadata dict.
+        
+    The parsed HEADER and TEXT segments are cached (until the file changes
+    on disk), so checking a file's metadata and then reading its events 
+    only parses the TEXT segment once.
+
+    Returns
+    -------
+    (dict, pandas.DataFrame), or dict if `meta_data_only` is True.
+
+    Raises
+    ------
+    CytoflowFCSNotSupported
+        If the file uses a feature this reader doesn't implement.
+
+    CytoflowFCSError
+        If the file is malformed.
+    """
+
+    meta = _cached_meta(filename)
+
+    if meta_data_only:
+        return meta
+
+    return (meta, _map_data(filename, meta))
+
+def _cached_meta(filename):
+    """Return a copy of `filename`'s metadata, parsing it if it isn't cached"""
+    
+    path = os.path.abspath(filename)
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        raise CytoflowFCSError("Can't read {0}: {1}".format(filename, e))
+    
+    key = (path, st.st_mtime, st.st_size)
+    
+    with _meta_cache_lock:
+        meta = _meta_cache.pop(key, None)
+        if meta is not None:
+            _meta_cache[key] = meta
+    
+    if meta is None:
+        meta = _read_meta(filename)
+        with _meta_cache_lock:
+            _meta_cache[key] = meta
+            while len(_meta_cache) > _META_CACHE_SIZE:
+                _meta_cache.popitem(last = False)
+    
+    # callers are free to modify what we give them
+    meta = dict(meta)
+    meta["__header__"] = dict(meta["__header__"])
+    meta["_channels_"] = meta["_channels_"].copy()
+    return meta
+
+def _read_meta(filename):
+    """Parse the HEADER and TEXT segments into a (reformatted) metadata dict"""
+
+    file_size = os.path.getsize(filename)
+
+    with open(filename, 'rb') as f:
+        header = f.read(58)
+        if len(header) < 58 or not header.startswith(b"FCS"):
+            raise CytoflowFCSError("{0} is not an FCS file".format(filename))
+
+        offsets = []
+        for i in range(10, 58, 8):
+            try:
+                offsets.append(int(header[i:i+8]))
+            except ValueError:
+                offsets.append(0)
+
+        text_start, text_end, data_start, data_end, _, _ = offsets
+
+        if text_start == 0 or text_end == 0 or text_end > file_size:
+            raise CytoflowFCSError("Can't locate the TEXT segment in {0}"
+                                   .format(filename))
+
+        # some writers set text end == data start
+        if text_end == data_start:
+            text_end -= 1
+
+        f.seek(text_start)
+        raw_text = f.read(text_end - text_start + 1)
+
+    if not isinstance(raw_text, str):
+        raw_text = raw_text.decode('utf-8', 'replace')
+
+    text = _parse_text(raw_text)
+
+    try:
+        num_pars = int(text["$PAR"])
+        text["$PAR"] = num_pars
+        text["$TOT"] = int(text["$TOT"])
+        for n in range(1, num_pars + 1):
+            text["$P{0}B".format(n)] = int(text["$P{0}B".format(n)])
+        if "$NEXTDATA" in text:
+            text["$NEXTDATA"] = int(text["$NEXTDATA"])
+    except (KeyError, ValueError) as e:
+        raise CytoflowFCSError("Missing or invalid required keyword in {0}: {1}"
+                               .format(filename, e))
+
+    # large files put the DATA offsets in the TEXT segment instead
+    if data_start == 0 or data_end == 0:
+        try:
+            data_start = int(text["$BEGINDATA"])
+            data_end = int(text["$ENDDATA"])
+        except (KeyError, ValueError):
+            raise CytoflowFCSError("Can't locate the DATA segment in {0}"
+                                   .format(filename))
+
+    text["__header__"] = {"FCS format" : header[0:6],
+                          "text start" : text_start,
+                          "text end" : text_end,
+                          "data start" : data_start,
+                          "data end" : data_end,
+                          "analysis start" : offsets[4],
+                          "analysis end" : offsets[5]}
+
+    return _reformat_meta(text, num_pars)
+
+def _parse_text(raw_text):
+    """Split a TEXT segment into a dict of keyword --> value"""
+
+    delim = raw_text[0]
+    raw_text = raw_text[1:]
+    if raw_text.endswith(delim):
+        raw_text = raw_text[:-1]
+
+    # a delimiter in a keyword or value is escaped by doubling it.  split on
+    # the escaped delimiters first, then stitch the pieces back together.
+    elements = []
+    for idx, chunk in enumerate(raw_text.split(delim * 2)):
+        pieces = chunk.split(delim)
+        if idx > 0:
+            elements[-1] += delim + pieces[0]
+            pieces = pieces[1:]
+        elements.extend(pieces)
+
+    keys = [k.strip().upper() for k in elements[0::2]]
+    return dict(zip(keys, elements[1::2]))
+
+def _reformat_meta(meta, num_pars):
+    """
+    Move the per-channel keywords into a DataFrame, the way
+    `fcsparser.parse(reformat_meta = True)` does
+    """
+
+    properties = set()
+    for key in meta:
+        m = _CHANNEL_KEYWORD.match(key)
+        if m and 1 <= int(m.group(1)) <= num_pars:
+            properties.add(m.group(2))
+    properties = sorted(properties)
+
+    channels = pd.DataFrame([[meta.pop("$P{0}{1}".format(n, p), None)
+                              for p in properties]
+                             for n in range(1, num_pars + 1)],
+                            columns = ["$Pn{0}".format(p) for p in properties],
+                            index = range(1, num_pars + 1))
+    channels.index.name = "Channel Number"
+
+    if "$PnE" in channels.columns:
+        channels["$PnE"] = channels["$PnE"].apply(lambda x: x.split(",")
+                                                  if x is not None else x)
+
+    meta["_channels_"] = channels
+    meta["_channel_names_"] = tuple(channels["$PnN"])
+    return meta
+
+def _map_data(filename, meta):
+    """Memory-map the DATA segment and wrap it in a DataFrame"""
+
+    mode = meta.get("$MODE", "L").strip()
+    if mode != "L":
+        raise CytoflowFCSNotSupported("$MODE {0} in {1} isn't supported"
+                                      .format(mode, filename))
+
+    datatype = meta.get("$DATATYPE", "").strip()
+    if datatype not in _DATATYPES:
+        raise CytoflowFCSNotSupported("$DATATYPE {0} in {1} isn't supported"
+                                      .format(datatype, filename))
+
+    byteord = meta.get("$BYTEORD", "").strip()
+    if byteord not in _BYTEORDS:
+        raise CytoflowFCSNotSupported("$BYTEORD {0} in {1} isn't supported"
+                                      .format(byteord, filename))
+
+    channels = meta["_channels_"]
+    bits = set(channels["$PnB"])
+    if len(bits) != 1:
+        raise CytoflowFCSNotSupported("Channels with different widths ($PnB) "
+                                      "in {0} aren't supported"
+                                      .format(filename))
+    bits = bits.pop()
+    if bits not in (8, 16, 32, 64) \
+       or (datatype == "F" and bits != 32) \
+       or (datatype == "D" and bits != 64):
+        raise CytoflowFCSNotSupported("$PnB {0} with $DATATYPE {1} in {2} "
+                                      "isn't supported"
+                                      .format(bits, datatype, filename))
+
+    dtype = np.dtype("{0}{1}{2}".format(_BYTEORDS[byteord],
+                                        _DATATYPES[datatype],
+                                        bits // 8))
+
+    num_events = meta["$TOT"]
+    num_pars = meta["$PAR"]
+    data_start = meta["__header__"]["data start"]
+    data_end = meta["__header__"]["data end"]
+
+    if num_events * num_pars * dtype.itemsize > data_end - data_start + 1 \
+       or data_start + num_events * num_pars * dtype.itemsize \
+            > os.path.getsize(filename):
+        raise CytoflowFCSError("The DATA segment in {0} is truncated"
+                               .format(filename))
+
+    if num_events > 0:
+        data = np.memmap(filename,
+                         dtype = dtype,
+                         mode = 'r',
+                         offset = data_start,
+                         shape = (num_events, num_pars))
+    else:
+        data = np.empty((0, num_pars), dtype = dtype)
+
+    # pandas doesn't like non-native byte orders
+    native = "<" if sys.byteorder == "little" else ">"
+    if dtype.byteorder not in ("=", "|", native):
+        data = data.astype(dtype.newbyteorder("="))
+
+    # integer data: mask off the bits above each channel's range
+    if datatype == "I":
+        ranges = np.array([float(r) for r in channels["$PnR"]])
+        masks = 2 ** np.ceil(np.log2(ranges)) - 1
+        if np.any(masks < 2 ** bits - 1):
+            data = data & masks.astype(data.dtype)
+
+    return pd.DataFrame(data,
+                        columns = list(meta["_channel_names_"]),
+                        copy = False)
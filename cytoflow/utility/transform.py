@@ -0,0 +1,133 @@
+from __future__ import division
+
+import numpy as np
+
+class Transform(object):
+    """
+    A parameterized, invertible transformation of a channel's values.
+
+    Operations that transform a channel put one of these in the channel's
+    `xforms` metadata (and its `inverted` counterpart in `xforms_inv`.)
+    Unlike a lambda, a Transform can be pickled -- so an `Experiment` can be
+    sent to another process -- and compared with `==`.
+
+    Subclasses set `tname`, keep their parameters as plain attributes, and
+    override `forward()` and `inverse()`.  Both must accept a number or an
+    array-like (including a `pandas.Series`) of them.
+
+    Calling a Transform applies `forward()`.
+    """
+
+    # a short, canonical name for the kind of transform
+    tname = None
+
+    def forward(self, x):
+        raise NotImplementedError
+
+    def inverse(self, y):
+        raise NotImplementedError
+
+    def __call__(self, x):
+        return self.forward(x)
+
+    @property
+    def inverted(self):
+        """A Transform that applies this one's inverse"""
+        return InverseTransform(self)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__,
+                                 ", ".join("{0}={1!r}".format(k, v)
+                                           for k, v in sorted(vars(self).items())))
+
+class InverseTransform(Transform):
+    """The inverse of another Transform"""
+
+    def __init__(self, transform):
+        self.transform = transform
+
+    @property
+    def tname(self):
+        return "inverse " + str(self.transform.tname)
+
+    def forward(self, x):
+        return self.transform.inverse(x)
+
+    def inverse(self, y):
+        return self.transform.forward(y)
+
+    @property
+    def inverted(self):
+        return self.transform
+
+class ComposedTransform(Transform):
+    """
+    Several Transforms applied one after the other, in order.
+
+    Examples
+    --------
+    >>> t = ComposedTransform([LinearTransform(offset = -100),
+    ...                        PowerTransform(a = 1.1, b = 2)])
+    >>> t(x)            # same as 2 * (x - 100) ** 1.1
+    >>> t.inverse(t(x)) # == x
+    """
+
+    tname = "composed"
+
+    def __init__(self, transforms):
+        # flatten nested compositions
+        self.transforms = []
+        for t in transforms:
+            if isinstance(t, ComposedTransform):
+                self.transforms.extend(t.transforms)
+            else:
+                self.transforms.append(t)
+
+    def forward(self, x):
+        for t in self.transforms:
+            x = t.forward(x)
+        return x
+
+    def inverse(self, y):
+        for t in reversed(self.transforms):
+            y = t.inverse(y)
+        return y
+
+class LinearTransform(Transform):
+    """y = scale * x + offset"""
+
+    tname = "linear"
+
+    def __init__(self, scale = 1.0, offset = 0.0):
+        self.scale = scale
+        self.offset = offset
+
+    def forward(self, x):
+        return self.scale * x + self.offset
+
+    def inverse(self, y):
+        return (y - self.offset) / self.scale
+
+class PowerTransform(Transform):
+    """y = b * x ^ a"""
+
+    tname = "power"
+
+    def __init__(self, a = 1.0, b = 1.0):
+        self.a = a
+        self.b = b
+
+    def forward(self, x):
+        return self.b * np.power(x, self.a)
+
+    def inverse(self, y):
+        return np.power(y / self.b, 1 / self.a)
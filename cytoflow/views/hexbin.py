@@ -91,7 +91,7 @@ class HexbinView(HasStrictTraits):
         if self.subset:
             try: 
                 data = experiment.query(self.subset)
-            except:
+            except Exception:
                 raise CytoflowViewError("Subset string \'{0}\' not valid")
         else:
             data = experiment.data
@@ -86,7 +86,7 @@ class HistogramView(HasStrictTraits):
         if self.subset:
             try:
                 data = experiment.query(self.subset)
-            except:
+            except Exception:
                 raise CytoflowViewError("Subset string '{0}' isn't valid"
                                         .format(self.subset))
         else:
@@ -88,7 +88,7 @@ class ScatterplotView(HasStrictTraits):
         if self.subset:
             try:
                 data = experiment.query(self.subset)
-            except:
+            except Exception:
                 raise CytoflowViewError("Subset string '{0}' isn't valid"
                                         .format(self.subset))
         else:
@@ -158,7 +158,7 @@ class Stats1DView(HasStrictTraits):
         if self.subset:
             try:
                 data = experiment.query(self.subset)
-            except:
+            except Exception:
                 raise 
         else:
             data = experiment.data
@@ -185,7 +185,7 @@ class Stats2DView(HasStrictTraits):
         if self.subset:
             try:
                 data = experiment.query(self.subset)
-            except:
+            except Exception:
                 raise CytoflowViewError("Subset string '{0}' isn't valid"
                                         .format(self.subset))
         else:
@@ -29,14 +29,28 @@ from util import UniquePriorityQueue
 import threading
 import pickle as pickle
 
+# a job for the worker thread is a (priority, item) tuple.  item is either
+# the WorkflowItem to update, (PREVIEW, wi) to preview wi's result, or 
+# (PREPARE, wi) to get wi's result ready to plot.  the priority orders the 
+# jobs: the previews come first, in workflow order, then the updates (see 
+# FlowTask._update_from()).  each update (or preview) needs the result of 
+# the ones before it, and they run one at a time in this order, so it has it.
+PREVIEW = "preview"
+PREPARE = "prepare"
+
 # setup the worker thread
 def update_model(flag, lock, to_update):
     while flag.wait():
         flag.clear()
         while not to_update.empty():
             with lock:
-                _, wi = to_update.get_nowait()
-            wi.update()
+                _, item = to_update.get_nowait()
+            if not isinstance(item, tuple):
+                item.update()
+            elif item[0] == PREVIEW:
+                item[1].update_preview()
+            else:
+                item[1].prepare()
 
 
 class FlowTask(Task):
@@ -105,6 +119,15 @@ class FlowTask(Task):
     # are we debugging?  ie, do we need a default setup?
     debug = Bool
     
+    # preview each WorkflowItem on a subset of the events before updating it
+    # (see WorkflowItem.update_preview())
+    preview = Bool(True)
+    
+    # one worker thread runs the jobs (see update_model().)  more wouldn't
+    # help: each update needs the one before it, a data preparation holds 
+    # its result's lock (which the next update needs, to clone it), and the
+    # GIL serializes everything else.  the parallel work happens in worker
+    # processes instead (see ImportOp.pool.)
     worker = Instance(threading.Thread)
     to_update = Instance(UniquePriorityQueue, ())
     worker_flag = Instance(threading.Event, args = ())
@@ -218,16 +241,46 @@ class FlowTask(Task):
             self.model.workflow[:] = new_model.workflow
             self.model.selected = new_model.selected   
         
-        wi = self.model.workflow[0]
+        self._update_from(self.model.workflow[0])
+        
+    def _update_from(self, wi):
+        """
+        Invalidate `wi` and the WorkflowItems after it, and queue them to be
+        updated.  
+        
+        If `preview` is set, they're all previewed (in order) first, then
+        updated (in order): so there's something to plot right away.  
+        Bumping the generation abandons any update that's already running
+        with the old parameters.
+        """
+        
+        num_items = len(self.model.workflow)
+        
         while True:
             wi.valid = "invalid"
+            wi.generation += 1
+            idx = self.model.workflow.index(wi)
             with self.worker_lock:
-                self.to_update.put_nowait((self.model.workflow.index(wi), wi))
+                if self.preview:
+                    self.to_update.put_nowait((idx, (PREVIEW, wi)))
+                self.to_update.put_nowait((num_items + idx, wi))
             if wi.next:
                 wi = wi.next
             else:
                 break
             
+        # get the selected WorkflowItem's result ready to plot as soon as 
+        # it's updated, before the WorkflowItems after it are updated.
+        selected = self.model.selected
+        if selected is not None:
+            idx = self.model.workflow.index(selected)
+            with self.worker_lock:
+                self.to_update.put_nowait((num_items + idx + 0.5, 
+                                           (PREPARE, selected)))
+        
+        self._start_worker()
+        
+    def _start_worker(self):
         # check to see if we have a worker thread around
         if not self.worker or not self.worker.is_alive():
             self.worker = threading.Thread(target = update_model, 
@@ -365,30 +418,8 @@ class FlowTask(Task):
     @on_trait_change("model:selected:operation:+")
     def operation_parameters_updated(self): 
         
-        # invalidate this workflow item and all the ones following it
-        wi = self.model.selected
-        while True:
-            wi.valid = "invalid"
-            with self.worker_lock:
-                self.to_update.put_nowait((self.model.workflow.index(wi), wi))
-            if wi.next:
-                wi = wi.next
-            else:
-                break
-            
-        # check to see if we have a worker thread around
-        if not self.worker or not self.worker.is_alive():
-            self.worker = threading.Thread(target = update_model, 
-                                           args = (self.worker_flag, 
-                                                   self.worker_lock,
-                                                   self.to_update))
-            self.worker.daemon = True
-            self.worker.start()
-            
-        # start the worker thread processing
-        with self.worker_lock:
-            if not self.to_update.empty():
-                self.worker_flag.set()
+        # invalidate this workflow item and all the ones following it.  
+        self._update_from(self.model.selected)
         
     def set_current_view(self, view_id):
         """
@@ -5,14 +5,14 @@ Created on Feb 11, 2015
 """
 from pyface.tasks.api import TaskPane
 from matplotlib_editor import MPLFigureEditor
-from traits.api import Instance, provides
+from traits.api import Instance, Int, provides
 from pyface.tasks.i_task_pane import ITaskPane
+from pyface.api import GUI, error
 import matplotlib.pyplot as plt
+from matplotlib_backend import submit, render_figure, render_image
 
 from cytoflow.utility import CytoflowViewError
 
-import threading, time
-
 @provides(ITaskPane)
 class FlowTaskPane(TaskPane):
     """
@@ -26,6 +26,10 @@ class FlowTaskPane(TaskPane):
     
     editor = Instance(MPLFigureEditor)
     
+    # incremented by each plot() and clear_plot(), so we only show the 
+    # latest plot
+    _plot_generation = Int(0)
+    
     def create(self, parent):
         self.editor = MPLFigureEditor(parent)
         self.control = self.editor.control
@@ -35,6 +39,9 @@ class FlowTaskPane(TaskPane):
         self.control = self.editor = None 
         
     def clear_plot(self):
+        # forget about any plots that are still in progress
+        self._plot_generation += 1
+        
         self.editor.clear = True
         self.editor.draw = True
         
@@ -42,25 +49,17 @@ class FlowTaskPane(TaskPane):
         """
         Plot the an experiment in the center pane.
         
+        The view plots, and the figure is rendered, on the render thread 
+        (see matplotlib_backend.submit()); the finished image is swapped 
+        into the pane on the UI thread.  If plot() is called again before
+        that, the old plot is dropped.  Nothing touches pyplot or draws 
+        on the UI thread.
+        
         Arguments
         ---------
         wi : WorkflowItem
             The WorkflowItem (data + current view) to plot
         """
-         
-#         # TODO - make this multithreaded.  atm this returns "Cannot set parent,
-#         # new parent is in a different thread."
-#         def do_plot(view, experiment):
-#             view.plot(experiment)
-#                  
-#         t = threading.Thread(target = do_plot,
-#                              args = (view, experiment))
-#         t.start()
-#         t.join()
-#         
-#         self.editor.clear = True
-#         self.editor.figure = plt.gcf()
-#         self.editor.draw = True
         
         # TODO - view.plot is going to create a new figure.  get the new
         # figure with plt.gcf() and keep track of the mapping between figure
@@ -75,37 +74,85 @@ class FlowTaskPane(TaskPane):
             self.clear_plot()
             return
         
-        if wi.current_view == wi.default_view:
+        view = wi.current_view
+        
+        if view == wi.default_view:
             # plotting the default view
-            try:
-                wi.current_view.plot(wi.previous.result)
-            except CytoflowViewError as e:
-                wi.current_view.error = e.__str__()
-            else:
-                wi.current_view.error = ""
+            experiment = wi.previous.result
         else:
             if not wi.result:
                 self.clear_plot()
                 return
             
+            experiment = wi.result
+            
+        self._plot_generation += 1
+        generation = self._plot_generation
+        size = (self.control.width(), self.control.height())
+        
+        def do_plot():
+            if generation != self._plot_generation:
+                return
+            
             try:
-                wi.current_view.plot(wi.result)
+                view.plot(experiment)
             except CytoflowViewError as e:
-                wi.current_view.error = e.__str__()
+                error = e.__str__()
             else:
-                wi.current_view.error = ""
-
-        self.editor.figure = plt.gcf()
+                error = ""
+                
+            figure = plt.gcf()
+            image = render_image(render_figure(figure, size))
+            GUI.invoke_later(self._show_plot, 
+                             generation, view, figure, image, error)
+            
+        submit(do_plot)
+        
+    def _show_plot(self, generation, view, figure, image, error):
+        """Swap a finished plot into the pane (on the UI thread)"""
+        
+        if generation != self._plot_generation:
+            return
+        
+        view.error = error
+        
+        # this gives the figure its Qt canvas
+        self.editor.figure = figure
+        figure.canvas.swap(image)
            
-        if "interactive" in wi.current_view.traits():
-            # we have to re-bind the Cursor to the new Axes object by twiddling
-            # the "interactive" trait
-            wi.current_view.interactive = False
-            wi.current_view.interactive = True 
+        if "interactive" in view.traits():
+            def rebind():
+                if generation != self._plot_generation:
+                    return
+                
+                # we have to re-bind the Cursor to the new Axes object (and
+                # canvas) by twiddling the "interactive" trait
+                plt.figure(figure.number)
+                view.interactive = False
+                view.interactive = True
+                
+            submit(rebind)
             
     def export(self, filename):
         # TODO - eventually give a preview, allow changing size, dpi, aspect 
         # ratio, plot layout, etc.  at the moment, just export exactly what's
         # on the screen
-        plt.savefig(filename, bbox_inches = 'tight')
+        figure = self.editor.figure
+        if figure:
+            def export():
+                try:
+                    figure.savefig(filename, bbox_inches = 'tight')
+                except Exception as e:
+                    # nobody's waiting on the render thread: report it on 
+                    # the UI thread
+                    GUI.invoke_later(error, 
+                                     self.control,
+                                     "Couldn't export the plot to {0}: {1}"
+                                     .format(filename, e))
+                
+                # saving re-rendered the figure at the export dpi; put the 
+                # on-screen image back
+                figure.canvas.draw()
+                
+            submit(export)
         
\ No newline at end of file
@@ -33,7 +33,7 @@ from collections import Counter
 
 from cytoflow import Tube as CytoflowTube
 
-import fcsparser
+from cytoflow.utility import parse_fcs
 
 def not_true ( value ):
     return (value is not True)
@@ -349,13 +349,11 @@ class ExperimentDialogHandler(Controller):
         
         for path in file_dialog.paths:
             try:
-                tube_meta = fcsparser.parse(path, 
-                                            meta_data_only = True, 
-                                            reformat_meta = True)
+                tube_meta = parse_fcs(path, meta_data_only = True)
                 tube_channels = tube_meta["_channels_"].set_index("$PnN")
             except Exception as e:
                 raise RuntimeError("FCS reader threw an error on tube {0}: {1}"\
-                                   .format(path, e.value))
+                                   .format(path, e))
                 
             tube = Tube()
             
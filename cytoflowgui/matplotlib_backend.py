@@ -5,11 +5,15 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import six
+from six.moves import queue
 
 import os  # not used
 import sys
+import math
 import ctypes
 import warnings
+import threading
+import traceback
 
 import matplotlib
 from matplotlib.figure import Figure
@@ -17,8 +21,8 @@ from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QTAgg
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAggBase
 
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.backends.backend_qt4 import QtCore
+from matplotlib.backends.backend_agg import FigureCanvasAgg, RendererAgg
+from matplotlib.backends.backend_qt4 import QtCore, QtGui
 from matplotlib.backends.backend_qt4 import FigureManagerQT
 from matplotlib.backends.backend_qt4 import FigureCanvasQT
 from matplotlib.backends.backend_qt4 import NavigationToolbar2QT
@@ -27,18 +31,274 @@ from matplotlib.backends.backend_qt4 import show
 from matplotlib.backends.backend_qt4 import draw_if_interactive as qt4_draw_if_interactive
 from matplotlib.backends.backend_qt4 import backend_version
 ######
-from matplotlib.cbook import mplDeprecation
+from matplotlib.cbook import mplDeprecation, CallbackRegistry
 
 from matplotlib.backend_bases import FigureManagerBase
+from matplotlib._pylab_helpers import Gcf
 
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg
 
+from pyface.api import GUI
+
 DEBUG = False
 
 _decref = ctypes.pythonapi.Py_DecRef
 _decref.argtypes = [ctypes.py_object]
 _decref.restype = None
 
+# the render thread.  pyplot's state (the current figure, etc) isn't 
+# thread-safe, and neither is drawing a figure, so all the plotting and 
+# drawing -- and the canvas' event handlers, which draw too -- happens on 
+# this one thread, in the order it was asked for.  the UI thread only 
+# paints the finished images.
+_render_queue = queue.Queue()
+_render_thread = None
+_render_lock = threading.Lock()
+
+def _render_loop():
+    while True:
+        fn = _render_queue.get()
+        try:
+            fn()
+        except Exception:
+            traceback.print_exc()
+
+def submit(fn):
+    """
+    Call `fn()` on the render thread.
+    """
+    global _render_thread
+    
+    with _render_lock:
+        if _render_thread is None or not _render_thread.is_alive():
+            _render_thread = threading.Thread(target = _render_loop)
+            _render_thread.daemon = True
+            _render_thread.start()
+            
+    _render_queue.put(fn)
+    
+def on_render_thread(fn):
+    """
+    Call `fn()` now if this is the render thread; otherwise, submit() it.  
+    For trait handlers that draw, which run on whatever thread changed the 
+    trait.
+    """
+    if threading.current_thread() is _render_thread:
+        fn()
+    else:
+        submit(fn)
+    
+def render_figure(figure, size = None):
+    """
+    Draw `figure` into a new, offscreen Agg renderer and return it.  Doesn't
+    touch Qt, so it's safe to call off the UI thread.
+    
+    Parameters
+    ----------
+    figure : matplotlib.figure.Figure
+        The figure to draw.
+        
+    size : (Int, Int) (default = None)
+        The size to draw it, in pixels.  If None, use the figure's size.
+    """
+    
+    if size is not None and min(size) > 0:
+        dpi = figure.dpi
+        figure.set_size_inches(size[0] / dpi, size[1] / dpi)
+        
+    w, h = figure.bbox.size
+    renderer = RendererAgg(w, h, figure.dpi)
+    
+    RendererAgg.lock.acquire()
+    try:
+        figure.draw(renderer)
+    finally:
+        RendererAgg.lock.release()
+        
+    return renderer
+
+def render_image(renderer, rect = None):
+    """
+    Copy `renderer`'s pixels (or just those in the QRect `rect`) into a 
+    QImage.  QImages (unlike QPixmaps) can be made off the UI thread.
+    """
+    
+    if QtCore.QSysInfo.ByteOrder == QtCore.QSysInfo.LittleEndian:
+        buf = renderer._renderer.tostring_bgra()
+    else:
+        buf = renderer._renderer.tostring_argb()
+        
+    image = QtGui.QImage(buf, 
+                         renderer.width, 
+                         renderer.height,
+                         QtGui.QImage.Format_ARGB32)
+    
+    # the copy has its own pixels, so it outlives buf
+    return image.copy(rect) if rect is not None else image.copy()
+
+class _RenderThreadCallbacks(CallbackRegistry):
+    """
+    Runs a canvas' event handlers (ie, widgets like Cursor and SpanSelector,
+    which draw on the figure and blit it) on the render thread, so that 
+    they don't race with rendering the figure.
+    """
+    
+    def process(self, s, *args, **kwargs):
+        if threading.current_thread() is _render_thread:
+            CallbackRegistry.process(self, s, *args, **kwargs)
+            return
+        
+        # the Qt event will be gone by the time the handlers run
+        for arg in args:
+            if hasattr(arg, "guiEvent"):
+                arg.guiEvent = None
+                
+        submit(lambda: CallbackRegistry.process(self, s, *args, **kwargs))
+        
+class FigureCanvasCytoflow(FigureCanvasQTAgg):
+    """
+    A Qt canvas that draws its figure off the UI thread.
+    
+    All the drawing happens on the render thread (see submit()): draw() 
+    renders the figure there, into a new offscreen Agg image, and the event
+    handlers run there too (see _RenderThreadCallbacks), so what they draw
+    and blit doesn't race with a rendering.  The UI thread only paints 
+    finished images: swap() replaces the whole image in one step, and 
+    blit() pastes in the region that changed.  Until then, the canvas keeps
+    showing the old image and the event loop keeps running.
+    """
+    
+    def __init__(self, figure):
+        # the image on the screen, with its own copy of the pixels
+        self._image = None
+        
+        # how many times draw() has been called
+        self._requested = 0
+        
+        # the widget's size, to render the figure at.  kept up to date by
+        # resizeEvent(), so the render thread doesn't have to ask Qt.
+        self._size = None
+        
+        FigureCanvasQTAgg.__init__(self, figure)
+        self.callbacks = _RenderThreadCallbacks()
+        
+        # Give the keyboard focus to the figure instead of the
+        # manager; StrongFocus accepts both tab and click to focus and
+        # will enable the canvas to process event w/o clicking.
+        # ClickFocus only takes the focus if the window has been
+        # clicked on. 
+        # http://qt-project.org/doc/qt-4.8/qt.html#FocusPolicy-enum or
+        # http://doc.qt.digia.com/qt/qt.html#FocusPolicy-enum
+        self.setFocusPolicy(QtCore.Qt.StrongFocus)
+        self.setFocus()
+        
+    def draw(self):
+        self._requested += 1
+        requested = self._requested
+        
+        def render():
+            # skip it if there's already a newer request queued
+            if requested != self._requested:
+                return
+            
+            renderer = render_figure(self.figure, self._size)
+            GUI.invoke_later(self.swap, render_image(renderer))
+            
+        submit(render)
+        
+    def draw_idle(self):
+        self.draw()
+        
+    def get_renderer(self, cleared = False):
+        # blitting (copy_from_bbox(), restore_region()) has to work on the
+        # image that draw_artist() draws on: the one the figure was last
+        # drawn into.  (cleared = True is a new drawing, ie print_figure())
+        renderer = getattr(self.figure, "_cachedRenderer", None)
+        if renderer is not None and not cleared:
+            return renderer
+        
+        return FigureCanvasQTAgg.get_renderer(self, cleared = cleared)
+    
+    def blit(self, bbox = None):
+        """
+        Show the region `bbox` (or all) of the figure's last rendering, 
+        after a widget has drawn on it.  Call on the render thread.
+        """
+        
+        renderer = self.get_renderer()
+        if bbox is None:
+            GUI.invoke_later(self.swap, render_image(renderer))
+            return
+        
+        l, b, r, t = bbox.extents
+        x, y = int(l), int(renderer.height - t)
+        rect = QtCore.QRect(x, 
+                            y, 
+                            int(math.ceil(r)) - x,
+                            int(math.ceil(renderer.height - b)) - y)
+        
+        GUI.invoke_later(self._paste, render_image(renderer, rect), rect)
+        
+    def swap(self, image):
+        """
+        Show a finished rendering of the figure (from render_image()).  
+        Call on the UI thread.
+        """
+        
+        self._image = image
+        self.update()
+        
+    def _paste(self, image, rect):
+        """Paste part of a rendering into the image on the screen"""
+        
+        if self._image is None:
+            return
+        
+        painter = QtGui.QPainter(self._image)
+        painter.drawImage(rect.topLeft(), image)
+        painter.end()
+        
+        self.update(rect)
+        
+    def paintEvent(self, event):
+        if self._image is None:
+            return
+        
+        # only repaint what changed (ie, the region that was blitted)
+        rect = event.rect()
+        painter = QtGui.QPainter(self)
+        painter.drawImage(rect, self._image, rect)
+        painter.end()
+        
+    def resizeEvent(self, event):
+        # FigureCanvasQT re-renders on the UI thread here.  the figure gets
+        # resized when it's rendered (see draw()); if it's already been 
+        # rendered at this size, there's nothing to do.
+        QtGui.QWidget.resizeEvent(self, event)
+        
+        self._size = (event.size().width(), event.size().height())
+        if self._image is None or \
+           (self._image.width(), self._image.height()) != self._size:
+            self.draw()
+            
+        self.resize_event()
+        
+def canvas_for(figure):
+    """
+    Get the FigureCanvasCytoflow for `figure`, making one if it doesn't have
+    one yet (ie, it was made off the UI thread.)  Call on the UI thread.
+    """
+    
+    if not isinstance(figure.canvas, FigureCanvasCytoflow):
+        canvas = FigureCanvasCytoflow(figure)
+        
+        # keep pyplot pointed at the new canvas
+        manager = Gcf.figs.get(getattr(figure, "number", None))
+        if manager is not None and manager.canvas.figure is figure:
+            manager.canvas = canvas
+            
+    return figure.canvas
+        
 class FigureManagerCytoflow(FigureManagerBase):
     """
     Public attributes
@@ -53,16 +313,6 @@ class FigureManagerCytoflow(FigureManagerBase):
         print ("new figure manager")
         FigureManagerBase.__init__(self, canvas, num)
         self.canvas = canvas
-
-        # Give the keyboard focus to the figure instead of the
-        # manager; StrongFocus accepts both tab and click to focus and
-        # will enable the canvas to process event w/o clicking.
-        # ClickFocus only takes the focus if the window has been
-        # clicked on. 
-        # http://qt-project.org/doc/qt-4.8/qt.html#FocusPolicy-enum or
-        # http://doc.qt.digia.com/qt/qt.html#FocusPolicy-enum
-        self.canvas.setFocusPolicy(QtCore.Qt.StrongFocus)
-        self.canvas.setFocus()
         
     def show(self):
         print("show figure")
@@ -80,14 +330,10 @@ def new_figure_manager(num, *args, **kwargs):
     Create a new figure manager instance
     """
     
-    # TODO - register the new figure/canvas with the editor?  the task?
-    # anyways, something; then, seaborn can plot at will and render to
-    # the aggregator associated with this canvas; and when it's done,
-    # we can swap in the canvas in the ui.
-    
-    # this also will solve the multithreading plotting problem, because
-    # only the swap/draw_if_interactive has to happen on the UI thread;
-    # the rest of the rendering to the agg can happen in another thread.
+    # views plot on the render thread (see submit()), and we can't make a
+    # Qt widget there.  so, the figure starts out with a plain Agg canvas,
+    # and the editor gives it a FigureCanvasCytoflow (see canvas_for()) 
+    # when it's shown.
     
     FigureClass = kwargs.pop('FigureClass', Figure)
     thisFig = FigureClass(*args, **kwargs)
@@ -97,7 +343,10 @@ def new_figure_manager(num, *args, **kwargs):
     # we set the dpi and figure size manually here ..... why?  i don't know.
     thisFig.set_dpi(96)
     thisFig.set_size_inches(5, 5)
-    canvas = FigureCanvasQTAgg(thisFig)
+    if isinstance(threading.current_thread(), threading._MainThread):
+        canvas = FigureCanvasCytoflow(thisFig)
+    else:
+        canvas = FigureCanvasAgg(thisFig)
     return FigureManagerCytoflow(canvas, num)
 
 def draw_if_interactive():
@@ -106,6 +355,6 @@ def draw_if_interactive():
     qt4_draw_if_interactive()
 
 
-FigureCanvas = FigureCanvasQTAgg
+FigureCanvas = FigureCanvasCytoflow
 FigureManager = FigureManagerCytoflow
 
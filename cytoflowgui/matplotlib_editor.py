@@ -18,7 +18,7 @@ import matplotlib
 
 # We want matplotlib to use our backend
 matplotlib.use('module://matplotlib_backend')
-from matplotlib_backend import FigureCanvas
+from matplotlib_backend import FigureCanvas, canvas_for, submit
 from matplotlib.figure import Figure
 
 from traits.api import Instance, Event
@@ -55,8 +55,9 @@ class MPLFigureEditor(Widget):
         pass
     
     def _clear(self):
+        # the figure is only drawn on the render thread
         if self.figure:
-            self.figure.clear()
+            submit(self.figure.clear)
         
     def _draw(self):
         if self.figure:
@@ -71,7 +72,8 @@ class MPLFigureEditor(Widget):
             del self._canvas
             
         if new:
-            self._canvas = new.canvas
+            # a figure plotted off the UI thread doesn't have a Qt canvas yet
+            self._canvas = canvas_for(new)
             self._layout.addWidget(self._canvas)
             self._canvas.setParent(self.control)
 
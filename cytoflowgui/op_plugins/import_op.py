@@ -18,6 +18,7 @@ from cytoflowgui.op_plugins.i_op_plugin \
     import IOperationPlugin, OpHandlerMixin, PluginOpMixin
 from pyface.api import OK as PyfaceOK
 from cytoflow import ImportOp
+from cytoflow.operations.import_op import worker_pool
 from cytoflow.operations.i_operation import IOperation
 from envisage.api import Plugin
 from cytoflowgui.color_text_editor import ColorTextEditor
@@ -91,6 +92,22 @@ class ImportHandler(Controller, OpHandlerMixin):
 @provides(IOperation)
 class ImportPluginOp(ImportOp, PluginOpMixin):
     handler_factory = Callable(ImportHandler)
+    
+    # parse the FCS files in parallel, in the processes that 
+    # start_worker_pool() started.  (pool is transient, so it isn't saved
+    # or part of the result's key.)
+    def _pool_default(self):
+        return _worker_pool
+        
+# the GUI's pool of processes to parse FCS files with.  forking while other
+# threads hold locks (Qt's, the FCS reader's, the render thread's) could 
+# deadlock the child, so it's started once, by run.py, before anything else.
+_worker_pool = None
+
+def start_worker_pool():
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = worker_pool()
             
 @provides(IOperationPlugin)
 class ImportPlugin(Plugin):
@@ -6,11 +6,12 @@ Created on Apr 25, 2015
 
 from traitsui.api import View, Item, EnumEditor, Controller
 from envisage.api import Plugin, contributes_to
-from traits.api import provides, Callable
+from traits.api import provides, Callable, on_trait_change
 from cytoflowgui.op_plugins import IOperationPlugin, OpHandlerMixin, OP_PLUGIN_EXT
 from cytoflow.operations.polygon import PolygonOp, PolygonSelection
 from pyface.api import ImageResource
 from cytoflowgui.view_plugins.i_view_plugin import ViewHandlerMixin, PluginViewMixin
+from matplotlib_backend import on_render_thread
 from cytoflowgui.subset_editor import SubsetEditor
 from cytoflow.views.i_selectionview import ISelectionView
 from cytoflowgui.op_plugins.i_op_plugin import PluginOpMixin
@@ -54,6 +55,16 @@ class PolygonViewHandler(Controller, ViewHandlerMixin):
 class PolygonSelectionView(PolygonSelection, PluginViewMixin):
     handler_factory = Callable(PolygonViewHandler)
     
+    # these draw, with pyplot: so they have to run on the render thread,
+    # whichever thread changed the trait (see matplotlib_backend.submit())
+    @on_trait_change('op.vertices', post_init = True)
+    def _draw_poly(self):
+        on_render_thread(lambda: PolygonSelection._draw_poly(self))
+        
+    @on_trait_change('interactive', post_init = True)
+    def _interactive(self):
+        on_render_thread(lambda: PolygonSelection._interactive(self))
+    
 class PolygonPluginOp(PolygonOp, PluginOpMixin):
     handler_factory = Callable(PolygonHandler)
 
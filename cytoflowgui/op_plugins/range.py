@@ -1,10 +1,11 @@
 from traitsui.api import View, Item, EnumEditor, Controller
 from envisage.api import Plugin, contributes_to
-from traits.api import provides, Callable
+from traits.api import provides, Callable, on_trait_change
 from cytoflowgui.op_plugins import IOperationPlugin, OpHandlerMixin, OP_PLUGIN_EXT
 from cytoflow.operations.range import RangeOp, RangeSelection
 from pyface.api import ImageResource
 from cytoflowgui.view_plugins.i_view_plugin import ViewHandlerMixin, PluginViewMixin
+from matplotlib_backend import on_render_thread
 from cytoflowgui.subset_editor import SubsetEditor
 from cytoflow.views.i_selectionview import ISelectionView
 from cytoflow.operations.i_operation import IOperation
@@ -47,6 +48,16 @@ class RangeViewHandler(Controller, ViewHandlerMixin):
 class RangeSelectionView(RangeSelection, PluginViewMixin):
     handler_factory = Callable(RangeViewHandler)
     
+    # these draw, with pyplot: so they have to run on the render thread,
+    # whichever thread changed the trait (see matplotlib_backend.submit())
+    @on_trait_change('op.low, op.high', post_init = True)
+    def _draw_span(self):
+        on_render_thread(lambda: RangeSelection._draw_span(self))
+        
+    @on_trait_change('interactive', post_init = True)
+    def _interactive(self):
+        on_render_thread(lambda: RangeSelection._interactive(self))
+    
 @provides(IOperation)
 class RangePluginOp(RangeOp, PluginOpMixin):
     handler_factory = Callable(RangeHandler)
@@ -6,12 +6,13 @@ Created on Apr 25, 2015
 
 from traitsui.api import View, Item, EnumEditor, Controller
 from envisage.api import Plugin, contributes_to
-from traits.api import provides, Callable
+from traits.api import provides, Callable, on_trait_change
 from cytoflowgui.op_plugins.i_op_plugin \
     import IOperationPlugin, OpHandlerMixin, PluginOpMixin, OP_PLUGIN_EXT
 from cytoflow.operations.range2d import Range2DOp, RangeSelection2D
 from pyface.api import ImageResource
 from cytoflowgui.view_plugins.i_view_plugin import ViewHandlerMixin, PluginViewMixin
+from matplotlib_backend import on_render_thread
 from cytoflowgui.subset_editor import SubsetEditor
 from cytoflow.views.i_selectionview import ISelectionView
 from cytoflowgui.color_text_editor import ColorTextEditor
@@ -59,6 +60,16 @@ class RangeView2DHandler(Controller, ViewHandlerMixin):
 class Range2DSelectionView(RangeSelection2D, PluginViewMixin):
     handler_factory = Callable(RangeView2DHandler)
     
+    # these draw, with pyplot: so they have to run on the render thread,
+    # whichever thread changed the trait (see matplotlib_backend.submit())
+    @on_trait_change('op.xlow, op.xhigh, op.ylow, op.yhigh', post_init = True)
+    def _draw_rect(self):
+        on_render_thread(lambda: RangeSelection2D._draw_rect(self))
+        
+    @on_trait_change('interactive', post_init = True)
+    def _interactive(self):
+        on_render_thread(lambda: RangeSelection2D._interactive(self))
+    
 class Range2DPluginOp(Range2DOp, PluginOpMixin):
     handler_factory = Callable(Range2DHandler)
 
@@ -1,11 +1,12 @@
 from traitsui.api import View, Item, EnumEditor, Controller
 from envisage.api import Plugin, contributes_to
-from traits.api import provides, Callable
+from traits.api import provides, Callable, on_trait_change
 from cytoflowgui.op_plugins.i_op_plugin \
     import IOperationPlugin, OpHandlerMixin, PluginOpMixin, OP_PLUGIN_EXT
 from pyface.api import ImageResource
 from cytoflow.operations.threshold import ThresholdOp, ThresholdSelection
 from cytoflowgui.view_plugins.i_view_plugin import ViewHandlerMixin, PluginViewMixin
+from matplotlib_backend import on_render_thread
 from cytoflowgui.subset_editor import SubsetEditor
 from cytoflowgui.color_text_editor import ColorTextEditor
 
@@ -42,6 +43,16 @@ class ThresholdViewHandler(Controller, ViewHandlerMixin):
 class ThresholdSelectionView(ThresholdSelection, PluginViewMixin):
     handler_factory = Callable(ThresholdViewHandler)
     
+    # these draw, with pyplot: so they have to run on the render thread,
+    # whichever thread changed the trait (see matplotlib_backend.submit())
+    @on_trait_change('op.threshold', post_init = True)
+    def _draw_threshold(self):
+        on_render_thread(lambda: ThresholdSelection._draw_threshold(self))
+        
+    @on_trait_change('interactive', post_init = True)
+    def _interactive(self):
+        on_render_thread(lambda: ThresholdSelection._interactive(self))
+    
 class ThresholdPluginOp(ThresholdOp, PluginOpMixin):
     handler_factory = Callable(ThresholdHandler)
 
@@ -22,10 +22,12 @@ from cytoflow_application import CytoflowApplication
 from op_plugins import ImportPlugin, ThresholdPlugin, HLogPlugin, RangePlugin, \
                        Range2DPlugin, PolygonPlugin, LogiclePlugin, \
                        BinningPlugin, LogPlugin
+from op_plugins.import_op import start_worker_pool
 from view_plugins import HistogramPlugin, HexbinPlugin, ScatterplotPlugin, \
                          BarChartPlugin, Stats1DPlugin
                          
 import sys
+import multiprocessing
 
 def run_gui():
     
@@ -46,6 +48,10 @@ def run_gui():
     logging.shutdown()
 
 if __name__ == '__main__':
+    # the frozen Windows build starts the worker processes by running this
+    # executable again; this is where they stop and do their work.
+    multiprocessing.freeze_support()
+    
     from pyface.qt import qt_api
     
     if qt_api == "pyside":
@@ -62,4 +68,7 @@ if __name__ == '__main__':
         sys.exit(1)
     
 
+    # before any other threads start (see start_worker_pool())
+    start_worker_pool()
+
     run_gui()
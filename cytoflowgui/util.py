@@ -27,4 +27,4 @@ class UniquePriorityQueue(PriorityQueue):
     def _get(self, heappop=heapq.heappop):
         item = PriorityQueue._get(self, heappop)
         self.values.remove(item[1])
-        return item
\ No newline at end of file
+        return item
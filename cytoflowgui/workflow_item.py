@@ -4,17 +4,44 @@ Created on Mar 15, 2015
 @author: brian
 '''
 
-from traits.api import HasStrictTraits, Instance, List, DelegatesTo, Enum, \
-                       Property, cached_property, Bool, on_trait_change, \
-                       Dict, Str
+import os
+import hashlib
+import pickle
+
+from traits.api import HasTraits, HasStrictTraits, Instance, List, \
+                       DelegatesTo, Enum, Property, cached_property, Bool, \
+                       on_trait_change, Dict, Str, Int
 from traitsui.api import View, Item, Handler
-from cytoflow import Experiment
+from cytoflow import Experiment, ImportOp
 from cytoflow.operations.i_operation import IOperation
 from cytoflow.views.i_view import IView
-from cytoflow.utility import CytoflowError
+from cytoflow.utility import CytoflowCancelled, LRUCache, \
+                             cancellable
 from pyface.qt import QtGui
 from pyface.tasks.api import Task
 
+# recent results, shared by all the WorkflowItems and keyed on the 
+# operation's parameters and the previous item's result (see 
+# WorkflowItem.update()), so that going back to a previous set of 
+# parameters doesn't re-run the operation.  the least recently used ones 
+# are dropped when they use more than _RESULT_CACHE_BYTES.  each result is
+# sized by the columns it doesn't share with the previous item's result
+# (see Experiment.nbytes_apart_from()), so shared columns aren't counted 
+# over and over.
+_RESULT_CACHE_SIZE = 64
+_RESULT_CACHE_BYTES = 1024 ** 3
+
+_result_cache = LRUCache(maxsize = _RESULT_CACHE_SIZE,
+                         maxbytes = _RESULT_CACHE_BYTES,
+                         sizeof = lambda experiment: experiment.nbytes)
+
+# about how many events a preview uses (see WorkflowItem.update_preview())
+_PREVIEW_EVENTS = 10000
+
+# process the events in chunks this big, so an update that's been 
+# superseded can stop part-way through (see WorkflowItem.update())
+_CHUNK_SIZE = 1 << 18
+
 class WorkflowItem(HasStrictTraits):
     """        
     The basic unit of a Workflow: wraps an operation and a list of views.
@@ -49,6 +76,14 @@ class WorkflowItem(HasStrictTraits):
     # previous WorkflowItem's ``result``
     result = Instance(Experiment, transient = True)
     
+    # identifies ``result``: a hash of the operation's parameters and the
+    # previous WorkflowItem's ``result_key``.  empty if the result can't be
+    # cached.
+    result_key = Str(transient = True)
+    
+    # is ``result`` a preview (see update_preview())?
+    preview = Bool(False, transient = True)
+    
     # the channels and conditions from result.  usually these would be
     # Property traits (ie, determined dynamically), but we need to cache them
     # so that persistence works properly.
@@ -78,6 +113,12 @@ class WorkflowItem(HasStrictTraits):
     # if we errored out, what was the error string?
     error = Str(transient = True)
     
+    # incremented (by the controller, on the UI thread) every time this 
+    # wi needs to be updated again.  an update that's running when it
+    # changes is stale: it stops at the next chunk of events, and its 
+    # result is thrown away.
+    generation = Int(0, transient = True)
+    
     # the icon for the vertical notebook view.  Qt specific, sadly.
     icon = Property(depends_on = 'valid', transient = True)
     
@@ -89,24 +130,174 @@ class WorkflowItem(HasStrictTraits):
     def update(self):
         """
         Called by the controller to update this wi
+        
+        If `generation` changes while we're working (ie, the user changed a
+        parameter again), give up: the controller has already queued 
+        another update.
         """
     
+        generation = self.generation
+        stale = lambda: self.generation != generation
+        
         self.valid = "updating"
         self.error = ""
-        self.result = None
         
-        prev_result = self.previous.result if self.previous else None
+        # keep showing the preview (if there is one) until we're done
+        if not self.preview:
+            self.result = None
+            self.result_key = ""
         
-        try:
-            self.result = self.operation.apply(prev_result)
-        except CytoflowError as e:
+        if self.previous:
+            prev_result = self.previous.result
+            prev_key = self.previous.result_key
+            key = _result_key(self.operation, prev_key) if prev_key else ""
+        else:
+            prev_result = None
+            key = _result_key(self.operation, "")
+            
+        result = _result_cache.get(key) if key else None
+        
+        if result is None:
+            try:
+                with cancellable(stale):
+                    result = self.operation.apply(prev_result)
+            except CytoflowCancelled:
+                self.valid = "invalid"
+                return
+            except Exception as e:
+                # not just CytoflowErrors: anything else would kill the
+                # worker thread
+                self.valid = "invalid"
+                self.error = e.__str__()    
+                self.preview = False
+                self.result = None
+                self.result_key = ""
+                return
+            
+            # clones inherit the chunk size, so this covers the whole 
+            # workflow
+            if not self.previous and result is not None \
+               and result.chunk_size == 0:
+                result.chunk_size = _CHUNK_SIZE
+            
+            # if it's stale, the parameters changed while the operation was
+            # reading them, so the result may not match `key`
+            if stale():
+                self.valid = "invalid"
+                return
+            
+            if key and result is not None:
+                _result_cache.put(key, result,
+                                  size = result.nbytes_apart_from(prev_result))
+                
+        if stale():
             self.valid = "invalid"
-            self.error = e.__str__()    
-            print self.error
             return
-
+        
+        self.result_key = key
+        self.preview = False
+        self.result = result
         self.valid = "valid"
-           
+        
+    def update_preview(self):
+        """
+        Called by the controller, before update(), for a quick look at the
+        result: apply the operation to a small, fixed subset of the events
+        (about _PREVIEW_EVENTS of them.)  The preview is `result` until 
+        update() replaces it.
+        
+        If there's no quick way to preview this wi (ie, the wi before it 
+        doesn't have a preview or an up-to-date result), do nothing.
+        """
+        
+        generation = self.generation
+        stale = lambda: self.generation != generation
+        
+        # an old preview mustn't be used to preview the wis after this one
+        self.preview = False
+        
+        operation = self.operation
+        
+        if self.previous:
+            if self.previous.preview:
+                prev_result = self.previous.result
+                prev_key = self.previous.result_key
+            elif self.previous.valid == "valid" and self.previous.result:
+                prev_result = \
+                    self.previous.result.subsample(_PREVIEW_EVENTS)
+                prev_key = self.previous.result_key
+                if prev_key:
+                    prev_key += "preview"
+            else:
+                return
+            
+            key = _result_key(operation, prev_key) if prev_key else ""
+        else:
+            operation = _preview_operation(operation)
+            if operation is None:
+                return
+            
+            prev_result = None
+            key = _result_key(operation, "")
+            
+        self.valid = "updating"
+            
+        result = _result_cache.get(key) if key else None
+        
+        if result is None:
+            try:
+                with cancellable(stale):
+                    result = operation.apply(prev_result)
+            except (CytoflowCancelled, Exception):
+                # update() will report the error
+                self.valid = "invalid"
+                return
+            
+            # (see update())
+            if stale():
+                self.valid = "invalid"
+                return
+            
+            if key and result is not None:
+                _result_cache.put(key, result,
+                                  size = result.nbytes_apart_from(prev_result))
+                
+        if stale():
+            self.valid = "invalid"
+            return
+        
+        self.result_key = key
+        self.preview = True
+        self.result = result
+
+    def prepare(self):
+        """
+        Called by the controller to apply the result's pending transforms
+        and filters (see Experiment.transform_channel()), so that plotting
+        it doesn't have to.  Runs right after this WorkflowItem's update, 
+        before the ones after it; like update(), it gives up if `generation`
+        changes.
+        """
+
+        generation = self.generation
+        result = self.result
+        if result is None:
+            return
+
+        stale = lambda: self.generation != generation
+
+        try:
+            with cancellable(stale):
+                result.apply_pending()
+        except CytoflowCancelled:
+            pass
+        except Exception as e:
+            # ie, a pending transform failed.  report it, rather than 
+            # killing the worker thread.
+            if not stale():
+                self.valid = "invalid"
+                self.error = e.__str__()
+
     @cached_property
     def _get_icon(self):
         if self.valid == "valid":
@@ -127,4 +318,90 @@ class WorkflowItem(HasStrictTraits):
  
         if new:
             self.channels = new.channels
-            self.conditions = new.conditions
\ No newline at end of file
+            self.conditions = new.conditions
+
+def _preview_operation(operation):
+    """
+    A copy of the ImportOp `operation` that imports a fixed subset of about
+    _PREVIEW_EVENTS events; or None if `operation` isn't an ImportOp, or if
+    it imports that few events anyway.
+    """
+    
+    if not isinstance(operation, ImportOp) or not operation.tubes:
+        return None
+    
+    events = max(_PREVIEW_EVENTS // len(operation.tubes), 1)
+    if operation.coarse and operation.coarse_events <= events:
+        return None
+    
+    preview = operation.clone_traits(copy = "shallow")
+    preview.coarse = True
+    preview.coarse_events = events
+    preview.coarse_seed = 0
+    
+    # it's small: parse it in this process, and keep it in memory
+    preview.pool = None
+    preview.workers = 1
+    preview.storage_dir = ""
+    
+    return preview
+
+def _result_key(operation, prev_key):
+    """
+    Hash `operation`'s parameters, the size and modification time of the
+    files they name, and `prev_key`; or return "" if the parameters can't be
+    pickled.
+    
+    The parameters are the public, non-transient traits (see _parameters());
+    what estimate() computed, like splines or mixture models, is private.
+    It follows from the parameters and the files, and it can be big.
+    """
+    
+    params = _parameters(operation)
+    
+    try:
+        state = pickle.dumps((params, _file_stamps(params)),
+                             pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return ""
+    
+    return hashlib.sha1(prev_key + state).hexdigest()
+
+def _parameters(value):
+    """
+    `value`, with any HasTraits in it (like an operation, or a Tube) 
+    replaced by its class name and its public, non-transient traits, and 
+    any dicts and sets by their sorted items, so it pickles the same way
+    every time.
+    """
+    
+    if isinstance(value, HasTraits):
+        traits = value.trait_get(transient = lambda t: t is None)
+        return (value.__class__.__name__,
+                _parameters({name : trait 
+                             for name, trait in traits.iteritems()
+                             if not name.startswith("_")}))
+    elif isinstance(value, dict):
+        return sorted((_parameters(k), _parameters(v))
+                      for k, v in value.iteritems())
+    elif isinstance(value, (set, frozenset)):
+        return sorted(_parameters(v) for v in value)
+    elif isinstance(value, (list, tuple)):
+        return [_parameters(v) for v in value]
+    else:
+        return value
+    
+def _file_stamps(params):
+    """
+    The (name, modification time, size) of each file named in `params`
+    (from _parameters()), so that changing a file changes the key.
+    """
+    
+    if isinstance(params, basestring):
+        if os.path.isfile(params):
+            stat = os.stat(params)
+            return [(params, stat.st_mtime, stat.st_size)]
+    elif isinstance(params, (list, tuple)):
+        return [stamp for p in params for stamp in _file_stamps(p)]
+        
+    return []